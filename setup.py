@@ -17,7 +17,10 @@ Please install cython and numpy prior to installing benepar.""")
 with open("README.md", "r") as f:
     long_description = f.read()
 
-extensions = cythonize("benepar/*.pyx")
+# Build with `python setup.py build_ext --inplace` to place the compiled
+# chart_helper module next to the sources in src/, where parse_nk imports it
+# without needing pyximport (and a compiler) at runtime.
+extensions = cythonize("src/chart_helper.pyx")
 for ext_module in extensions:
     ext_module.include_dirs.append(np.get_include())
 
@@ -31,8 +34,9 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/nikitakit/self-attentive-parser",
     packages=setuptools.find_packages(),
+    package_dir={'': 'src'},
     package_data={'': ['*.pyx']},
-    ext_modules = cythonize(extensions),
+    ext_modules=extensions,
     classifiers=(
         'Programming Language :: Python :: 2.7',
         "Programming Language :: Python :: 3",
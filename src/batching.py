@@ -0,0 +1,121 @@
+"""
+Length-sorted batching, used for inference and for splitting training
+batches into sub-batches. Sentences are sorted by their encoder
+length before being grouped, so that a batch is padded to the length of
+sentences similar to its own rather than to the longest sentence nearby in
+the input. Batches are limited by a number of sentences, a token budget
+(batch size * padded length), a quadratic cost budget
+(batch size * padded length ** 2, which tracks the size of the attention
+matrices), and/or a memory budget in bytes as estimated by the parser's
+estimate_batch_bytes. Results are returned in the original order.
+
+Training batches can also be grouped by length (make_bucketed_batches), at
+the cost of some randomness in their composition.
+"""
+
+import numpy as np
+
+def make_batches(lengths, max_sentences=None, max_tokens=None, max_cost=None, max_bytes=None, estimate_bytes=None):
+    """
+    Returns a list of batches, each a list of indices into lengths. A sentence
+    that exceeds a budget by itself is placed in a batch of its own.
+    estimate_bytes(batch_size, max_len) is required with max_bytes.
+    """
+    assert max_bytes is None or estimate_bytes is not None
+    order = np.argsort(np.asarray(lengths, dtype=int), kind='stable').tolist()
+    batches = []
+    batch = []
+    for i in order:
+        # Lengths are ascending, so the current sentence sets the padded length
+        size = len(batch) + 1
+        length = lengths[i]
+        if batch and (
+                (max_sentences is not None and size > max_sentences)
+                or (max_tokens is not None and size * length > max_tokens)
+                or (max_cost is not None and size * length * length > max_cost)
+                or (max_bytes is not None and estimate_bytes(size, length) > max_bytes)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def make_fixed_batches(num_sentences, batch_size):
+    """
+    Batches of batch_size consecutive sentences in input order
+    """
+    return [list(range(start, min(start + batch_size, num_sentences)))
+            for start in range(0, num_sentences, batch_size)]
+
+def make_bucketed_batches(lengths, batch_size, bucket_batches=50):
+    """
+    Training batches of batch_size sentences of similar length, in random
+    order. The sentences are shuffled and split into buckets of
+    bucket_batches batches; each bucket is sorted by length and cut into
+    batches. Smaller buckets are more random, larger ones pad less.
+    """
+    lengths = np.asarray(lengths, dtype=int)
+    order = np.random.permutation(len(lengths))
+    bucket_size = batch_size * bucket_batches
+    batches = []
+    for start in range(0, len(order), bucket_size):
+        bucket = order[start:start + bucket_size]
+        bucket = bucket[np.argsort(lengths[bucket], kind='stable')]
+        batches.extend(bucket[i:i + batch_size].tolist() for i in range(0, len(bucket), batch_size))
+    np.random.shuffle(batches)
+    return batches
+
+def pair_batches(batches, lengths, other_batches, other_lengths):
+    """
+    Pairs each batch with one of other_batches whose longest sentence has a
+    similar rank, so that mixing the two (e.g. gold and silver trees) keeps
+    batches of similar lengths. Other batches are reused or skipped if there
+    are fewer or more of them. Pairs are returned in the order of batches.
+    """
+    if not other_batches:
+        return [(batch, []) for batch in batches]
+    ranks = np.argsort([max(lengths[i] for i in batch) for batch in batches], kind='stable')
+    other_ranks = np.argsort([max(other_lengths[i] for i in batch) for batch in other_batches], kind='stable')
+    pairs = [None] * len(batches)
+    for rank, batch_num in enumerate(ranks):
+        pairs[batch_num] = (batches[batch_num], other_batches[other_ranks[rank * len(other_batches) // len(batches)]])
+    return pairs
+
+def padding_ratio(lengths, batches):
+    """
+    Fraction of the padded token positions that are padding
+    """
+    num_real = sum(lengths[i] for batch in batches for i in batch)
+    num_padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return 1.0 - num_real / max(num_padded, 1)
+
+def map_batches(fn, items, batches):
+    """
+    Calls fn on the items of each batch, and returns the concatenated results
+    in the original order of items
+    """
+    results = [None] * len(items)
+    for batch in batches:
+        for i, result in zip(batch, fn([items[i] for i in batch])):
+            results[i] = result
+    return results
+
+def parse_sentences(parser, sentences, max_sentences=None, max_tokens=None, max_cost=None, max_bytes=None, parse_fn=None, cache=None):
+    """
+    Parses sentences in length-sorted batches and returns the converted trees
+    in the original order. parse_fn(sentences) can replace parser.parse_batch,
+    e.g. to decode from averaged ensemble charts. With a parse_cache.ParseCache,
+    only sentences that are not in the cache are parsed.
+    """
+    if cache is not None:
+        return cache.parse(sentences, lambda missing: parse_sentences(
+            parser, missing, max_sentences=max_sentences, max_tokens=max_tokens,
+            max_cost=max_cost, max_bytes=max_bytes, parse_fn=parse_fn))
+
+    if parse_fn is None:
+        parse_fn = lambda batch_sentences: parser.parse_batch(batch_sentences)[0]
+    batches = make_batches(parser.sentence_lengths(sentences),
+        max_sentences=max_sentences, max_tokens=max_tokens, max_cost=max_cost,
+        max_bytes=max_bytes, estimate_bytes=parser.estimate_batch_bytes)
+    return map_batches(lambda batch_sentences: [p.convert() for p in parse_fn(batch_sentences)], sentences, batches)
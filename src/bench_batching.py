@@ -0,0 +1,55 @@
+"""
+Compares fixed-size batching in input order with length-sorted, budgeted
+batching (batching.make_batches) on a treebank: reports the number of
+batches, the fraction of padded positions, the largest estimated activation
+memory of any batch, and, with --parse, the time taken to parse the treebank
+with each batching.
+
+Lengths are subword lengths when the model uses BERT, and word lengths
+otherwise.
+
+Usage: python3 src/bench_batching.py --model-path-base MODEL --treebank-path swbd-data/autopos-nopunct-nopw/dev.txt [--parse]
+"""
+
+import argparse
+import time
+
+import batching
+import main as parser_main
+import trees
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path-base", required=True)
+    parser.add_argument("--treebank-path", default="swbd-data/autopos-nopunct-nopw/dev.txt")
+    parser.add_argument("--eval-batch-size", type=int, default=100)
+    parser.add_argument("--eval-batch-tokens", type=int, default=5000)
+    parser.add_argument("--eval-batch-cost", type=int)
+    parser.add_argument("--eval-batch-mb", type=float)
+    parser.add_argument("--parse", action="store_true", help="Also time parsing with each batching")
+    args = parser.parse_args()
+
+    treebank = trees.load_trees(args.treebank_path)
+    sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in treebank]
+    model = parser_main.load_parser(args.model_path_base)
+    lengths = model.sentence_lengths(sentences)
+
+    configs = [
+        ("fixed, input order", batching.make_fixed_batches(len(sentences), args.eval_batch_size)),
+        ("sorted, budgeted", batching.make_batches(lengths, estimate_bytes=model.estimate_batch_bytes, **parser_main.eval_batch_limits(args))),
+    ]
+
+    print("{:,} sentences, {:,} tokens, longest {}".format(len(sentences), sum(lengths), max(lengths)))
+    print("{:<20} {:>8} {:>9} {:>10} {:>10}".format("batching", "batches", "padding", "max MB", "parse(s)"))
+    for name, batches in configs:
+        elapsed = float('nan')
+        if args.parse:
+            start_time = time.perf_counter()
+            batching.map_batches(lambda batch: model.parse_batch(batch)[0], sentences, batches)
+            elapsed = time.perf_counter() - start_time
+        max_mb = max(model.estimate_batch_bytes(len(batch), max(lengths[i] for i in batch)) for batch in batches) / 2**20
+        print("{:<20} {:>8} {:>8.1%} {:>10.1f} {:>10.2f}".format(
+            name, len(batches), batching.padding_ratio(lengths, batches), max_mb, elapsed), flush=True)
+
+if __name__ == "__main__":
+    main()
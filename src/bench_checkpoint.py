@@ -0,0 +1,94 @@
+"""
+Training memory and throughput with and without activation checkpointing
+(the checkpoint_activations hparam) at several sub-batch sizes: for each
+configuration, runs a few training steps on a treebank and reports the peak
+resident memory of the process and the training throughput.
+
+Each configuration runs in a fresh process, since peak RSS only grows within
+a process. Checkpointing is switched on the loaded model, so any trained
+model can be used.
+
+Usage: python3 src/bench_checkpoint.py --model-path-base MODEL.pt --treebank-path swbd-data/autopos-nopunct-nopw/dev.txt --subbatch-max-tokens 500 1000 2000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+import main as parser_main
+import trees
+
+def run_config(args, subbatch_max_tokens, checkpoint_activations):
+    import torch
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    treebank = trees.load_trees(args.treebank_path)
+    sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in treebank]
+    golds = [tree.convert() for tree in treebank]
+
+    model = parser_main.load_parser(args.model_path_base)
+    model.spec['hparams']['checkpoint_activations'] = checkpoint_activations
+    if model.encoder is not None:
+        model.encoder.checkpoint_activations = checkpoint_activations
+    if model.bert is not None:
+        model.bert_checkpoint_activations = checkpoint_activations
+    model.train()
+    trainer = torch.optim.Adam([param for param in model.parameters() if param.requires_grad], lr=args.learning_rate)
+
+    def step(start):
+        batch_sentences = sentences[start:start + args.batch_size]
+        batch_golds = golds[start:start + args.batch_size]
+        trainer.zero_grad()
+        num_subbatches = 0
+        for subbatch_sentences, subbatch_golds in model.split_batch(batch_sentences, batch_golds, subbatch_max_tokens):
+            _, loss = model.parse_batch(subbatch_sentences, subbatch_golds)
+            if model.f_tag is not None:
+                loss = loss[0] + loss[1]
+            (loss / len(batch_sentences)).backward()
+            num_subbatches += 1
+        trainer.step()
+        return len(batch_sentences), num_subbatches
+
+    starts = [(i * args.batch_size) % len(sentences) for i in range(args.warmup + args.steps)]
+    for start in starts[:args.warmup]:
+        step(start)
+    num_sentences = 0
+    num_subbatches = 0
+    start_time = time.perf_counter()
+    for start in starts[args.warmup:]:
+        step_sentences, step_subbatches = step(start)
+        num_sentences += step_sentences
+        num_subbatches += step_subbatches
+    elapsed = time.perf_counter() - start_time
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak_mb, num_sentences / elapsed, num_subbatches / args.steps
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path-base", required=True)
+    parser.add_argument("--treebank-path", default="swbd-data/autopos-nopunct-nopw/dev.txt")
+    parser.add_argument("--subbatch-max-tokens", type=int, nargs="+", default=[500, 1000, 2000, 4000])
+    parser.add_argument("--batch-size", type=int, default=30)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--learning-rate", type=float, default=1e-5)
+    parser.add_argument("--num-threads", type=int, help="torch intra-op threads")
+    args = parser.parse_args()
+
+    print("{:<12} {:>10} {:>11} {:>10} {:>10}".format("subbatch", "checkpoint", "subbatches", "peak MB", "sents/s"))
+    for subbatch_max_tokens in args.subbatch_max_tokens:
+        for checkpoint_activations in [False, True]:
+            with multiprocessing.Pool(1) as pool:
+                peak_mb, sentences_per_second, subbatches_per_step = pool.apply(
+                    run_config, (args, subbatch_max_tokens, checkpoint_activations))
+            print("{:<12} {:>10} {:>11.1f} {:>10.0f} {:>10.1f}".format(
+                subbatch_max_tokens, "on" if checkpoint_activations else "off",
+                subbatches_per_step, peak_mb, sentences_per_second), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Latency benchmark for parsing one sentence at a time with
+NKChartParser.parse, as in interactive use. Sentences from the input file are
+parsed one by one, and the p50/p99 latencies are reported per sentence length
+bucket (in words).
+
+Usage: python3 src/bench_latency.py --model-path-base MODEL --input-path best_models/raw_sentences.txt
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import main as parser_main
+
+BUCKETS = [(1, 5), (6, 10), (11, 20), (21, 40), (41, 80), (81, None)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path-base", required=True)
+    parser.add_argument("--input-path", type=str, required=True)
+    parser.add_argument("--max-sentences", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--num-threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    args = parser.parse_args()
+
+    import torch
+    import parse_nk
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    with open(args.input_path) as input_file:
+        sentences = [line.split() for line in input_file if line.strip()][:args.max_sentences]
+    model = parser_main.load_parser(args.model_path_base)
+    dummy_tag = model.dummy_tag
+    sentences = [[(dummy_tag, word) for word in sentence] for sentence in sentences]
+
+    latencies = []
+    with parse_nk.precision_context(args.precision):
+        for sentence in sentences[:args.warmup]:
+            model.parse(sentence)
+        for sentence in sentences:
+            start_time = time.perf_counter()
+            tree, _ = model.parse(sentence)
+            tree.convert()
+            latencies.append(time.perf_counter() - start_time)
+
+    lengths = np.asarray([len(sentence) for sentence in sentences])
+    latencies = np.asarray(latencies) * 1000
+    print("{:<10} {:>9} {:>9} {:>9}".format("words", "sentences", "p50_ms", "p99_ms"))
+    for low, high in BUCKETS + [(1, None)]:
+        in_bucket = (lengths >= low) & (lengths <= (high if high is not None else lengths.max()))
+        if not in_bucket.any():
+            continue
+        name = "all" if (low, high) == (1, None) else "{}-{}".format(low, high) if high is not None else "{}+".format(low)
+        print("{:<10} {:>9} {:>9.2f} {:>9.2f}".format(
+            name, int(in_bucket.sum()),
+            np.percentile(latencies[in_bucket], 50), np.percentile(latencies[in_bucket], 99)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Load generator for the parse server (main.py serve). For each concurrency
+level, opens that many client connections which send sentences from the
+input file back to back, then reports throughput and latency percentiles
+together with the server's mean micro-batch size. When the server runs
+several worker processes, the batch size is that of the worker which
+handles the stats connection.
+
+Usage:
+    python3 src/main.py serve --model-path-base MODEL --socket-path /tmp/parser.sock &
+    python3 src/bench_server.py --socket-path /tmp/parser.sock --input-path best_models/raw_sentences.txt --concurrency 1 4 16 64
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+
+class Client:
+    def __init__(self, args):
+        if args.socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(args.socket_path)
+        else:
+            self.sock = socket.create_connection((args.host, args.port))
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, request):
+        self.sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        response = json.loads(self.rfile.readline().decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+def run_level(args, sentences, concurrency):
+    latencies = [[] for _ in range(concurrency)]
+    num_words = [0] * concurrency
+    clients = [Client(args) for _ in range(concurrency)]
+
+    def run_client(i):
+        client = clients[i]
+        for request_num in range(args.requests_per_client):
+            sentence = sentences[(i * args.requests_per_client + request_num) % len(sentences)]
+            start_time = time.perf_counter()
+            client.request({'sentence': sentence, 'output': args.output})
+            latencies[i].append(time.perf_counter() - start_time)
+            num_words[i] += len(sentence.split())
+
+    stats_client = Client(args)
+    stats_before = stats_client.request({'command': 'stats'})['stats']
+    threads = [threading.Thread(target=run_client, args=(i,)) for i in range(concurrency)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    stats_after = stats_client.request({'command': 'stats'})['stats']
+
+    for client in clients + [stats_client]:
+        client.close()
+
+    all_latencies = np.asarray([latency for client_latencies in latencies for latency in client_latencies]) * 1000
+    num_batches = stats_after['batches'] - stats_before['batches']
+    num_batch_sentences = stats_after['sentences'] - stats_before['sentences']
+    return {
+        'concurrency': concurrency,
+        'requests/s': len(all_latencies) / elapsed,
+        'words/s': sum(num_words) / elapsed,
+        'p50_ms': np.percentile(all_latencies, 50),
+        'p95_ms': np.percentile(all_latencies, 95),
+        'p99_ms': np.percentile(all_latencies, 99),
+        'mean_batch': num_batch_sentences / num_batches if num_batches else float('nan'),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket-path", type=str)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--input-path", type=str, required=True)
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument("--requests-per-client", type=int, default=50)
+    parser.add_argument("--output", choices=["tree", "tags"], default="tree")
+    args = parser.parse_args()
+
+    with open(args.input_path) as input_file:
+        sentences = [line.strip() for line in input_file if line.strip()]
+
+    columns = ['concurrency', 'requests/s', 'words/s', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_batch']
+    print(" ".join("{:>12}".format(column) for column in columns))
+    for concurrency in args.concurrency:
+        result = run_level(args, sentences, concurrency)
+        print(" ".join("{:>12.1f}".format(result[column]) if column != 'concurrency' else "{:>12}".format(result[column])
+                       for column in columns), flush=True)
+
+if __name__ == "__main__":
+    main()
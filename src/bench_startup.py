@@ -0,0 +1,66 @@
+"""
+Benchmark for process startup: measures the wall-clock time of
+`main.py --help` and of importing the main modules, each in a fresh
+interpreter.
+
+Usage: python3 src/bench_startup.py [--repeats 5] [--importtime]
+"""
+
+import argparse
+import os.path
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COMMANDS = [
+    ("python -c pass", ["-c", "pass"]),
+    ("main.py --help", [os.path.join(SRC_DIR, "main.py"), "--help"]),
+    ("import main", ["-c", "import main"]),
+    ("import parse_nk", ["-c", "import parse_nk"]),
+]
+
+def time_command(args, repeats):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=SRC_DIR, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start_time)
+    return times
+
+def print_slowest_imports(module, top):
+    # Each stderr line looks like: "import time: self [us] | cumulative | name"
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=SRC_DIR, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    entries = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative), name.strip()))
+    entries.sort(reverse=True)
+    print("Slowest imports (cumulative) for `import {}`:".format(module))
+    for cumulative, name in entries[:top]:
+        print("  {:>10.1f} ms  {}".format(cumulative / 1000, name))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true", help="Also list the slowest imports of parse_nk")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    print("{:<20} {:>10} {:>10}".format("command", "median(s)", "min(s)"))
+    for name, command in COMMANDS:
+        times = time_command(command, args.repeats)
+        print("{:<20} {:>10.3f} {:>10.3f}".format(name, statistics.median(times), min(times)), flush=True)
+
+    if args.importtime:
+        print_slowest_imports("parse_nk", args.top)
+
+if __name__ == "__main__":
+    main()
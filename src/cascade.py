@@ -0,0 +1,97 @@
+"""
+Confidence-gated cascade: a single (fast) model parses every sentence, and
+only sentences on which it is uncertain are re-parsed by the full
+chart-averaging ensemble.
+
+Uncertainty is measured on the fast model's label score chart with two
+margins:
+    label margin:  over the spans of the predicted tree, the smallest gap
+                   between the best and second-best label score
+    EDITED margin: over all spans, the smallest gap between the best
+                   EDITED label and the best other label (including the
+                   empty label), i.e. how close any span is to flipping
+                   into or out of EDITED
+A sentence is escalated when either margin is below its threshold. The fast
+model's charts are reused as its share of the ensemble average.
+"""
+
+import numpy as np
+
+import ensemble
+
+def tree_spans(tree):
+    spans = [(tree.left, tree.right)]
+    for child in getattr(tree, 'children', ()):
+        spans.extend(tree_spans(child))
+    return spans
+
+def label_margin(chart, tree):
+    spans = np.asarray(tree_spans(tree))
+    span_scores = chart[spans[:, 0], spans[:, 1]]
+    if span_scores.shape[1] < 2:
+        return np.inf
+    top2 = np.partition(span_scores, -2, axis=1)[:, -2:]
+    return float(np.min(top2[:, 1] - top2[:, 0]))
+
+def edited_margin(chart, edited_mask):
+    if not edited_mask.any() or edited_mask.all():
+        return np.inf
+    n = chart.shape[0]
+    i, j = np.triu_indices(n, k=1)
+    span_scores = chart[i, j]
+    best_edited = span_scores[:, edited_mask].max(1)
+    best_other = span_scores[:, ~edited_mask].max(1)
+    return float(np.min(np.abs(best_edited - best_other)))
+
+class CascadeParser:
+    def __init__(self, parsers, margin_threshold=1.0, edited_margin_threshold=1.0, threads_per_member=None, precision="fp32"):
+        """
+        parsers[0] is the fast model that parses every sentence; the ensemble
+        is made of all of the parsers
+        """
+        self.ensemble = ensemble.ParserEnsemble(parsers, threads_per_member=threads_per_member, precision=precision)
+        self.fast_parser = parsers[0]
+        self.margin_threshold = margin_threshold
+        self.edited_margin_threshold = edited_margin_threshold
+
+        label_vocab = self.fast_parser.label_vocab
+        self.edited_mask = np.asarray(
+            ['EDITED' in label_vocab.value(index) for index in range(label_vocab.size)])
+
+        self.num_sentences = 0
+        self.num_escalated = 0
+        self.label_margins = []
+        self.edited_margins = []
+
+    def parse_batch(self, sentences):
+        fast_charts = self.ensemble.member_charts(0, sentences, None)
+        predicted, _ = self.fast_parser.decode_from_chart_batch(sentences, fast_charts)
+
+        escalated = []
+        for i, (chart, tree) in enumerate(zip(fast_charts, predicted)):
+            margins = (label_margin(chart, tree), edited_margin(chart, self.edited_mask))
+            self.label_margins.append(margins[0])
+            self.edited_margins.append(margins[1])
+            if margins[0] < self.margin_threshold or margins[1] < self.edited_margin_threshold:
+                escalated.append(i)
+
+        self.num_sentences += len(sentences)
+        self.num_escalated += len(escalated)
+        if escalated:
+            escalated_sentences = [sentences[i] for i in escalated]
+            escalated_charts = self.ensemble.charts(
+                escalated_sentences, known_charts={0: [fast_charts[i] for i in escalated]})
+            escalated_predicted, _ = self.fast_parser.decode_from_chart_batch(escalated_sentences, escalated_charts)
+            for i, tree in zip(escalated, escalated_predicted):
+                predicted[i] = tree
+        return predicted
+
+    def stats(self):
+        return {
+            'sentences': self.num_sentences,
+            'escalated': self.num_escalated,
+            'escalated_fraction': self.num_escalated / max(self.num_sentences, 1),
+        }
+
+    def close(self):
+        self.ensemble.close()
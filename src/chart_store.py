@@ -0,0 +1,146 @@
+"""
+On-disk store of label score charts, such as the averaged charts of an
+ensemble that are used as soft targets when distilling it into one model, or
+the charts of a single ensemble member that are combined with others later
+(see main.py dump-charts and combine-charts).
+
+A chart store consists of:
+  - <base>.json: the key the charts were computed for (see store_key), the
+    label vocabulary, the sentence lengths and, optionally, the sentences
+  - <base>.npy: one array (float16 or float32) with a row per span, holding
+    the spans (i, j), 0 <= i < j <= n, of each sentence in the order of
+    span_indices. The empty label, whose score is always 0, is not stored.
+  - <base>.labels.npy: only when keeping the top-k labels per span, the
+    label index of each stored score. When reading, the other labels get a
+    score 1 below the lowest stored score of their span, so they never outrank
+    or tie with a stored label (decoding breaks ties by lowest label index).
+The arrays are memory-mapped when reading, so a store does not need to fit
+in memory.
+"""
+
+import hashlib
+import json
+import os.path
+
+import numpy as np
+
+import vocabulary
+
+def get_array_path(path, suffix=".npy"):
+    assert path.endswith(".json"), "Chart stores must have a .json extension"
+    return path[:-len(".json")] + suffix
+
+def span_indices(sentence_len):
+    """
+    The fencepost indices (i, j) of the spans of a sentence, in store order
+    """
+    return np.triu_indices(sentence_len + 1, k=1)
+
+def num_spans(sentence_len):
+    return sentence_len * (sentence_len + 1) // 2
+
+def store_key(fingerprints, sentences):
+    """
+    Hash of the models' fingerprints (see parse_cache.model_fingerprint) and
+    of the sentences, so that a stale store is never reused
+    """
+    key = hashlib.sha1()
+    key.update(json.dumps([fingerprints, sentences]).encode('utf-8'))
+    return key.hexdigest()
+
+def unpack(rows, sentence_len):
+    chart = np.zeros((sentence_len + 1, sentence_len + 1, rows.shape[1] + 1), dtype=np.float32)
+    span_i, span_j = span_indices(sentence_len)
+    chart[span_i, span_j, 1:] = rows
+    return chart
+
+class ChartWriter:
+    def __init__(self, path, key, lengths, label_vocab, dtype=np.float16, top_k=None, sentences=None):
+        self.path = path
+        self.key = key
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.label_vocab = label_vocab
+        self.sentences = sentences
+        self.offsets = np.concatenate([[0], np.cumsum([num_spans(n) for n in self.lengths])])
+
+        num_labels = label_vocab.size - 1
+        self.top_k = top_k if top_k is not None and top_k < num_labels else None
+        num_columns = num_labels if self.top_k is None else self.top_k
+        self.array = np.lib.format.open_memmap(get_array_path(path), mode='w+', dtype=dtype,
+            shape=(int(self.offsets[-1]), num_columns))
+        self.labels = None
+        if self.top_k is not None:
+            assert num_labels < 2**15
+            self.labels = np.lib.format.open_memmap(get_array_path(path, ".labels.npy"), mode='w+', dtype=np.int16,
+                shape=(int(self.offsets[-1]), num_columns))
+
+    def write(self, index, chart):
+        assert chart.shape[0] == self.lengths[index] + 1
+        span_i, span_j = span_indices(self.lengths[index])
+        rows = chart[span_i, span_j, 1:]
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if self.top_k is None:
+            self.array[start:end] = rows
+        else:
+            labels = np.argpartition(rows, -self.top_k, axis=1)[:, -self.top_k:]
+            self.array[start:end] = np.take_along_axis(rows, labels, axis=1)
+            self.labels[start:end] = labels
+
+    def close(self):
+        self.array.flush()
+        del self.array
+        if self.labels is not None:
+            self.labels.flush()
+            del self.labels
+        # The metadata is written last, so an interrupted store is not valid
+        with open(self.path, 'w') as f:
+            json.dump({
+                'key': self.key,
+                'label_vocab': self.label_vocab.to_dict(),
+                'lengths': self.lengths.tolist(),
+                'top_k': self.top_k,
+                'sentences': self.sentences,
+            }, f)
+
+class ChartStore:
+    def __init__(self, path):
+        with open(path) as f:
+            meta = json.load(f)
+        self.key = meta['key']
+        self.label_vocab = vocabulary.Vocabulary.from_dict(meta['label_vocab'])
+        self.lengths = np.asarray(meta['lengths'], dtype=np.int64)
+        self.top_k = meta.get('top_k')
+        self.sentences = meta.get('sentences')
+        if self.sentences is not None:
+            self.sentences = [[tuple(tag_word) for tag_word in sentence] for sentence in self.sentences]
+        self.offsets = np.concatenate([[0], np.cumsum([num_spans(n) for n in self.lengths])])
+        self.array = np.load(get_array_path(path), mmap_mode='r')
+        self.labels = None
+        if self.top_k is not None:
+            self.labels = np.load(get_array_path(path, ".labels.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def rows(self, index):
+        """
+        The float32 scores of a sentence: one row per span, in the order of
+        span_indices, and one column per label except the empty label
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        values = np.asarray(self.array[start:end], dtype=np.float32)
+        if self.top_k is None:
+            return values
+        rows = np.empty((end - start, self.label_vocab.size - 1), dtype=np.float32)
+        rows[:] = values.min(1, keepdims=True) - 1
+        np.put_along_axis(rows, np.asarray(self.labels[start:end], dtype=np.int64), values, axis=1)
+        return rows
+
+    def chart(self, index):
+        return unpack(self.rows(index), self.lengths[index])
+
+def is_valid(path, key):
+    if not os.path.exists(path) or not os.path.exists(get_array_path(path)):
+        return False
+    with open(path) as f:
+        return json.load(f)['key'] == key
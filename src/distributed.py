@@ -0,0 +1,67 @@
+"""
+Data-parallel training over several processes with torch.distributed and the
+gloo backend (see main.py train --distributed). Processes are started with
+torchrun (python -m torch.distributed.run), which sets the rank, world size
+and rendezvous address, on one machine or across nodes.
+
+Every process forms the same batches and takes a disjoint share of the trees
+of each batch. Losses are still divided by the size of the whole batch, so
+the gradients summed over the processes are those of a single-process run.
+Rank 0 evaluates on the development set, saves models and drives the
+learning rate schedule, and broadcasts its decisions to the other ranks.
+"""
+
+import datetime
+
+def init():
+    """
+    Joins the process group, and returns (rank, world size)
+    """
+    import torch.distributed as dist
+    # Other ranks wait in a collective while rank 0 runs a dev check
+    dist.init_process_group('gloo', timeout=datetime.timedelta(hours=2))
+    return dist.get_rank(), dist.get_world_size()
+
+def barrier():
+    import torch.distributed as dist
+    dist.barrier()
+
+def broadcast_object(value, src=0):
+    """
+    The value passed by rank src, on every rank
+    """
+    import torch.distributed as dist
+    values = [value]
+    dist.broadcast_object_list(values, src=src)
+    return values[0]
+
+def broadcast_parameters(module, src=0):
+    import torch.distributed as dist
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=src)
+
+def all_reduce_gradients(parameters):
+    """
+    Sums the gradients of the parameters over all ranks, in a single
+    all_reduce. A parameter ends up with a gradient if it had one on any rank
+    (e.g. a rank whose share of a batch was empty has none).
+    """
+    import torch
+    import torch.distributed as dist
+    parameters = list(parameters)
+    flat = torch.cat(
+        [param.grad.reshape(-1) if param.grad is not None else param.new_zeros(param.numel()) for param in parameters]
+        + [parameters[0].new_tensor([float(param.grad is not None) for param in parameters])])
+    dist.all_reduce(flat)
+
+    offset = 0
+    for param in parameters:
+        grad = flat[offset:offset + param.numel()].view_as(param)
+        offset += param.numel()
+        if param.grad is not None:
+            param.grad.copy_(grad)
+        else:
+            param.grad = grad.clone()
+    for param, has_grad in zip(parameters, flat[offset:].tolist()):
+        if not has_grad:
+            param.grad = None
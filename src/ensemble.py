@@ -0,0 +1,110 @@
+"""
+Ensembles of parsers that are combined by averaging their label score charts.
+
+Each member runs in its own thread with its own share of the torch intra-op
+threads, so that the members' forward passes overlap and the latency of the
+ensemble approaches that of its slowest member. Since all members run at
+once, the charts of every member can be in memory at the same time, which
+the batch size bounds. Members whose inputs are built the same way (same
+vocabularies and tokenizer) share a single prepare_batch call, so for
+example BERT tokenization is done once per batch.
+"""
+
+import concurrent.futures
+import json
+import os
+
+def preprocessing_key(parser):
+    """
+    Two parsers with the same key build identical inputs in prepare_batch
+    """
+    hparams = parser.spec['hparams']
+    key = {name: hparams[name] for name in [
+        'use_tags', 'use_words', 'use_chars_lstm', 'use_elmo', 'use_bert', 'use_bert_only',
+        'predict_tags', 'bert_model', 'bert_do_lower_case', 'bert_transliterate',
+    ]}
+    for name in ['tag_vocab', 'word_vocab', 'char_vocab']:
+        key[name] = parser.spec[name].to_dict()
+    if parser.bert is not None:
+        key['bert_vocab'] = list(parser.bert_tokenizer.vocab.items())
+    return json.dumps(key, sort_keys=True)
+
+class ParserEnsemble:
+    def __init__(self, parsers, threads_per_member=None, precision="fp32"):
+        import torch
+
+        # Ensure that label scores charts produced by the models can be combined
+        # using simple averaging
+        ref_label_vocab = parsers[0].label_vocab
+        for parser in parsers:
+            assert parser.label_vocab.indices == ref_label_vocab.indices
+
+        self.parsers = parsers
+        self.precision = precision
+
+        keys = [preprocessing_key(parser) for parser in parsers]
+        self.preprocessing_groups = {}
+        for member_num, key in enumerate(keys):
+            self.preprocessing_groups.setdefault(key, []).append(member_num)
+        self.preprocessing_groups = list(self.preprocessing_groups.values())
+
+        if threads_per_member is None:
+            threads_per_member = max(1, len(os.sched_getaffinity(0)) // len(parsers))
+        # One single-threaded executor per member, so that each member's
+        # intra-op thread count (which is set per thread) applies to it
+        self.executors = [
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, initializer=torch.set_num_threads, initargs=(threads_per_member,))
+            for _ in parsers
+        ]
+
+    def member_charts(self, member_num, sentences, prepared=None):
+        import parse_nk
+        # Autocast state is per thread, so it is entered in the member's thread
+        with parse_nk.precision_context(self.precision):
+            return self.parsers[member_num].parse_batch(sentences, return_label_scores_charts=True, prepared=prepared)
+
+    def charts(self, sentences, known_charts=None):
+        """
+        Returns the average label score chart of each sentence. known_charts
+        can map member numbers to charts that were already computed for
+        these sentences, which are then used instead of running the member.
+        """
+        if known_charts is None:
+            known_charts = {}
+        member_results = {}
+        for group in self.preprocessing_groups:
+            group = [member_num for member_num in group if member_num not in known_charts]
+            if not group:
+                continue
+            prepared = self.parsers[group[0]].prepare_batch(sentences)
+            for member_num in group:
+                member_results[member_num] = self.executors[member_num].submit(self.member_charts, member_num, sentences, prepared)
+
+        # Ensemble by averaging label score charts from different models
+        # We did not observe any benefits to doing weighted averaging, probably
+        # because all our parsers output label scores of around the same magnitude
+        # Members are added in a fixed order so that results are reproducible
+        chart_sums = None
+        for member_num in range(len(self.parsers)):
+            if member_num in known_charts:
+                charts = [chart.copy() for chart in known_charts[member_num]]
+            else:
+                charts = member_results.pop(member_num).result()
+            if chart_sums is None:
+                chart_sums = charts
+            else:
+                for chart_sum, chart in zip(chart_sums, charts):
+                    chart_sum += chart
+            del charts
+        for chart_sum in chart_sums:
+            chart_sum /= len(self.parsers)
+        return chart_sums
+
+    def parse_batch(self, sentences):
+        predicted, _ = self.parsers[0].decode_from_chart_batch(sentences, self.charts(sentences))
+        return predicted
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
@@ -0,0 +1,83 @@
+"""
+On-disk store of per-token features of sentences, computed once by a frozen
+network (e.g. the ELMo biLM, see main.py precompute-elmo) so that training
+reads them instead of running that network in every epoch.
+
+A feature store consists of two files:
+  - <base>.json: the words of each sentence, the number of rows stored for
+    it, the shape of a row, and a free-form description
+  - <base>.npy: one array (float16 or float32) of shape
+    (total rows,) + row shape, with the rows of each sentence in order
+The .npy file is memory-mapped when reading. Sentences are looked up by
+their words, so a store can serve any treebank whose sentences it contains.
+"""
+
+import json
+
+import numpy as np
+
+def get_array_path(path):
+    assert path.endswith(".json"), "Feature stores must have a .json extension"
+    return path[:-len(".json")] + ".npy"
+
+def sentence_key(sentence):
+    return tuple(word for _, word in sentence)
+
+class FeatureWriter:
+    def __init__(self, path, sentences, num_rows, row_shape, dtype=np.float16, description=None):
+        self.path = path
+        self.words = [list(sentence_key(sentence)) for sentence in sentences]
+        self.num_rows = list(num_rows)
+        self.row_shape = tuple(row_shape)
+        self.description = description
+        self.offsets = np.concatenate([[0], np.cumsum(self.num_rows)]).astype(np.int64)
+        self.array = np.lib.format.open_memmap(get_array_path(path), mode='w+', dtype=dtype,
+            shape=(int(self.offsets[-1]),) + self.row_shape)
+
+    def write(self, index, rows):
+        assert rows.shape == (self.num_rows[index],) + self.row_shape
+        self.array[self.offsets[index]:self.offsets[index + 1]] = rows
+
+    def close(self):
+        self.array.flush()
+        del self.array
+        # The metadata is written last, so an interrupted store is not valid
+        with open(self.path, 'w') as f:
+            json.dump({
+                'words': self.words,
+                'num_rows': self.num_rows,
+                'row_shape': self.row_shape,
+                'description': self.description,
+            }, f)
+
+class FeatureStore:
+    def __init__(self, path):
+        with open(path) as f:
+            meta = json.load(f)
+        self.description = meta['description']
+        self.row_shape = tuple(meta['row_shape'])
+        self.offsets = np.concatenate([[0], np.cumsum(meta['num_rows'])]).astype(np.int64)
+        self.indices = {tuple(words): index for index, words in enumerate(meta['words'])}
+        self.array = np.load(get_array_path(path), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.indices)
+
+    def find(self, sentence):
+        """
+        The index of a sentence in the store, or None
+        """
+        return self.indices.get(sentence_key(sentence))
+
+    def rows(self, index):
+        return np.asarray(self.array[self.offsets[index]:self.offsets[index + 1]], dtype=np.float32)
+
+    def gather(self, sentences):
+        """
+        The concatenated rows of the sentences, or None if any of them is
+        not in the store
+        """
+        indices = [self.find(sentence) for sentence in sentences]
+        if None in indices:
+            return None
+        return np.concatenate([self.rows(index) for index in indices])
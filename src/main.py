@@ -1,28 +1,80 @@
 import argparse
 import itertools
+import json
 import os.path
 import time
 import sys
-import torch
-import torch.optim.lr_scheduler
 
 import numpy as np
 import random
 
+import batching
 import evaluate
 import trees
 import vocabulary
 import nkutil
-import parse_nk
-tokens = parse_nk
+import prefetch
 import evaluate_EDITED
 
+# torch, and the modules that depend on it (parse_nk, slim_checkpoint), are
+# imported inside the functions that use them. This keeps argument parsing
+# (e.g. --help) and other lightweight entry points from paying for loading
+# torch and probing for CUDA.
+
 def torch_load(load_path):
+    import torch
+    import parse_nk
     if parse_nk.use_cuda:
         return torch.load(load_path)
     else:
         return torch.load(load_path, map_location=lambda storage, location: storage)
 
+def load_parser(model_path):
+    import parse_nk
+    import slim_checkpoint
+    if model_path.endswith(".json"):
+        # Slim inference checkpoint: weights stay in a shared memory map
+        spec, state_dict = slim_checkpoint.load(model_path)
+        assign = True
+    else:
+        assert model_path.endswith(".pt"), "Only pytorch savefiles and slim .json checkpoints supported"
+        info = torch_load(model_path)
+        assert 'hparams' in info['spec'], "Older savefiles not supported"
+        spec, state_dict = info['spec'], info['state_dict']
+        assign = False
+
+    # Build BERT from the config stored next to the checkpoint rather than
+    # loading pretrained weights that the state_dict immediately overwrites
+    bert_files = parse_nk.get_bert_files(model_path)
+    if not all(os.path.exists(path) for path in bert_files):
+        bert_files = None
+    parser = parse_nk.NKChartParser.from_spec(spec, state_dict, bert_files=bert_files, assign=assign)
+
+    if parser.bert is not None and bert_files is None:
+        try:
+            parser.save_bert_files(model_path)
+            print("Saved BERT config and vocabulary next to {} for faster loading".format(model_path))
+        except OSError as e:
+            print("Could not save BERT config and vocabulary next to {}: {}".format(model_path, e))
+    return parser
+
+def eval_batch_limits(args):
+    return dict(
+        max_sentences=args.eval_batch_size,
+        max_tokens=args.eval_batch_tokens,
+        max_cost=args.eval_batch_cost,
+        max_bytes=args.eval_batch_mb * 2**20 if args.eval_batch_mb is not None else None,
+    )
+
+def make_parse_cache(args, parser, fingerprint=None):
+    if args.parse_cache_size == 0:
+        return None
+    import parse_cache
+    if fingerprint is None:
+        fingerprint = parse_cache.model_fingerprint(parser, args.precision)
+    print("Using a parse cache of {:,} entries for model {}".format(args.parse_cache_size, fingerprint[:12]))
+    return parse_cache.ParseCache(fingerprint, max_entries=args.parse_cache_size, path=args.parse_cache_path)
+
 def format_elapsed(start_time):
     elapsed_time = int(time.time() - start_time)
     minutes, seconds = divmod(elapsed_time, 60)
@@ -85,63 +137,17 @@ def make_hparams():
         bert_model="bert-base-uncased",
         bert_do_lower_case=True,
         bert_transliterate="",
+        bert_freeze_layers=0, # BERT layers (above the embeddings) that are not fine-tuned
+        checkpoint_activations=False, # Recompute Encoder and BERT layer activations in the backward pass, to save memory
         )
 
-def run_train(args, hparams):
-    if args.numpy_seed is not None:
-        print("Setting numpy random seed to {}...".format(args.numpy_seed))
-        np.random.seed(args.numpy_seed)
-
-    # Make sure that pytorch is actually being initialized randomly.
-    # On my cluster I was getting highly correlated results from multiple
-    # runs, but calling reset_parameters() changed that. A brief look at the
-    # pytorch source code revealed that pytorch initializes its RNG by
-    # calling std::random_device, which according to the C++ spec is allowed
-    # to be deterministic.
-    seed_from_numpy = np.random.randint(2147483648)
-    print("Manual seed for pytorch:", seed_from_numpy)
-    torch.manual_seed(seed_from_numpy)
-
-    hparams.set_from_args(args)
-    print("Hyperparameters:")
-    hparams.print()
-
-    print("Loading gold training trees from {}...".format(args.gold_train_path)) 
-    print("Loading silver training trees from {}...".format(args.silver_train_path))
-    if hparams.predict_tags and args.train_path.endswith('10way.clean'):
-        print("WARNING: The data distributed with this repository contains "
-              "predicted part-of-speech tags only (not gold tags!) We do not "
-              "recommend enabling predict_tags in this configuration.")
-    gold_train_treebank = trees.load_trees(args.gold_train_path)
-    silver_train_treebank = trees.load_trees(args.silver_train_path)
-    
-    new_batch_size = int(args.batch_size * ((10-args.silver_weight)/10)) 
-    silver_batch_size = int(args.batch_size - new_batch_size)
-
-    if hparams.max_len_train > 0:
-        gold_train_treebank = [tree for tree in gold_train_treebank if len(list(tree.leaves())) <= hparams.max_len_train]
-        silver_train_treebank = [tree for tree in silver_train_treebank if len(list(tree.leaves())) <= hparams.max_len_train]
-        if int(silver_batch_size*(len(gold_train_treebank)/new_batch_size))+1 < len(silver_train_treebank):
-            silver_train_treebank = silver_train_treebank[:int(silver_batch_size*(len(gold_train_treebank)/new_batch_size))+1]
-
-    print("Loaded {:,} gold training examples.".format(len(gold_train_treebank)))
-    print("Loaded {:,} silver training examples.".format(len(silver_train_treebank)))
-
-    print("Loading development trees from {}...".format(args.dev_path))
-    dev_treebank = trees.load_trees(args.dev_path)
-    if hparams.max_len_dev > 0:
-        dev_treebank = [tree for tree in dev_treebank if len(list(tree.leaves())) <= hparams.max_len_dev]
-    print("Loaded {:,} development examples.".format(len(dev_treebank)))
-
-    print("Processing gold trees for training...")
-    gold_train_parse = [tree.convert() for tree in gold_train_treebank]
-
-    print("Processing silver trees for training...")
-    silver_train_parse = [tree.convert() for tree in silver_train_treebank]
-
-    train_parse = gold_train_parse + silver_train_parse
-
-    print("Constructing vocabularies...")
+def build_vocabularies(train_parse):
+    """
+    Builds the tag, word, label and char vocabularies of a set of converted
+    training trees
+    """
+    import parse_nk
+    tokens = parse_nk
 
     tag_vocab = vocabulary.Vocabulary()
     tag_vocab.index(tokens.START)
@@ -170,8 +176,6 @@ def run_train(args, hparams):
                 word_vocab.index(node.word)
                 char_set |= set(node.word)
 
-
-
     char_vocab = vocabulary.Vocabulary()
 
     # If codepoints are small (e.g. Latin alphabet), index by codepoint directly
@@ -200,6 +204,228 @@ def run_train(args, hparams):
     label_vocab.freeze()
     char_vocab.freeze()
 
+    return tag_vocab, word_vocab, label_vocab, char_vocab
+
+def add_bert_frozen_features(parser, args, sentences):
+    """
+    Loads (or computes) the output of the frozen bottom BERT layers for the
+    training and development sentences, so that training only runs the
+    layers above them
+    """
+    import torch
+    import feature_store
+    import parse_nk
+
+    hparams = parser.spec['hparams']
+    path = args.bert_frozen_cache or args.model_path_base + "-bert-frozen.json"
+    description = json.dumps({name: hparams[name] for name in [
+        'bert_model', 'bert_do_lower_case', 'bert_transliterate', 'bert_freeze_layers']}, sort_keys=True)
+    sentences = list({feature_store.sentence_key(sentence): sentence for sentence in sentences}.values())
+
+    if os.path.exists(path):
+        store = feature_store.FeatureStore(path)
+        if store.description == description and all(store.find(sentence) is not None for sentence in sentences):
+            print("Using frozen BERT layer outputs from {}".format(path))
+            parser.bert_frozen_features = store
+            return
+        del store
+
+    print("Computing the output of {} frozen BERT layers for {:,} sentences into {}...".format(
+        hparams['bert_freeze_layers'], len(sentences), path))
+    start_time = time.time()
+    lengths = parser.sentence_lengths(sentences)
+    writer = feature_store.FeatureWriter(path, sentences, lengths, (parser.bert.config.hidden_size,),
+        description=description)
+    for batch in batching.make_batches(lengths, estimate_bytes=parser.estimate_batch_bytes, **eval_batch_limits(args)):
+        prepared = parser.prepare_batch([sentences[i] for i in batch])
+        with torch.no_grad():
+            frozen_states = parser.bert_frozen_states(
+                parse_nk.from_numpy(prepared['bert_input_ids']), parse_nk.from_numpy(prepared['bert_input_mask']))
+        frozen_states = frozen_states.float().cpu().numpy()
+        for snum, i in enumerate(batch):
+            writer.write(i, frozen_states[snum, :lengths[i]])
+    writer.close()
+    parser.bert_frozen_features = feature_store.FeatureStore(path)
+    print("Computed frozen BERT layer outputs in {}".format(format_elapsed(start_time)))
+
+class LRSchedule:
+    """
+    The learning rate schedule of train and distill: a linear warmup over the
+    first learning_rate_warmup_steps batches, then step decay on plateaus of
+    the dev score, checked at the end of each epoch
+    """
+    def __init__(self, trainer, hparams):
+        import torch.optim.lr_scheduler
+
+        assert hparams.step_decay, "Only step_decay schedule is supported"
+        self.trainer = trainer
+        self.hparams = hparams
+        self.warmup_coeff = hparams.learning_rate / hparams.learning_rate_warmup_steps
+        self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            trainer, 'max',
+            factor=hparams.step_decay_factor,
+            patience=hparams.step_decay_patience,
+            verbose=True,
+        )
+
+    def set_lr(self, new_lr):
+        for param_group in self.trainer.param_groups:
+            param_group['lr'] = new_lr
+
+    def warmup(self, iteration):
+        iteration = iteration + 1
+        if iteration <= self.hparams.learning_rate_warmup_steps:
+            self.set_lr(iteration * self.warmup_coeff)
+
+    def warmup_done(self, iteration):
+        return (iteration + 1) > self.hparams.learning_rate_warmup_steps
+
+    def step(self, dev_score):
+        self.scheduler.step(dev_score)
+
+    def exhausted(self, processed_since_best, epoch_size):
+        """
+        Whether the dev score has not improved for as long as it takes to
+        decay the learning rate max_consecutive_decays times
+        """
+        return processed_since_best > ((self.hparams.step_decay_patience + 1) * self.hparams.max_consecutive_decays * epoch_size)
+
+class DevChecker:
+    """
+    Evaluates the model being trained on the development set, and keeps the
+    model with the best EDITED f-score so far at MODEL_PATH_BASE_Edev=SCORE.pt
+    """
+    def __init__(self, args, parser, trainer, dev_treebank, start_time):
+        self.args = args
+        self.parser = parser
+        self.trainer = trainer
+        self.dev_treebank = dev_treebank
+        self.dev_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in dev_treebank]
+        self.start_time = start_time
+        self.best_fscore = -np.inf
+        self.best_model_path = None
+        self.best_processed = 0
+        self.best_efscore = None
+
+    def check(self, total_processed):
+        import torch
+        import parse_nk
+
+        dev_start_time = time.time()
+
+        dev_predicted = batching.parse_sentences(self.parser, self.dev_sentences, **eval_batch_limits(self.args))
+
+        dev_fscore = evaluate.evalb(self.args.evalb_dir, self.dev_treebank, dev_predicted)
+        dev_efscore = evaluate_EDITED.Evaluate(self.dev_treebank, dev_predicted)
+
+        print(
+            "dev-fscore {} "
+            "dev_efscore {}"
+            "dev-elapsed {} "
+            "total-elapsed {}".format(
+                dev_fscore,
+                dev_efscore,
+                format_elapsed(dev_start_time),
+                format_elapsed(self.start_time)),   flush=True
+        )
+        # MJ - keep model with best efscore
+        if dev_efscore.efscore > self.best_fscore:
+            if self.best_model_path is not None:
+                paths = [self.best_model_path + ".pt"]
+                paths.extend(parse_nk.get_bert_files(self.best_model_path + ".pt"))
+                for path in paths:
+                    if os.path.exists(path):
+                        print(" Removing previous model file {}...".format(path), flush=True)
+                        os.remove(path)
+            self.best_efscore = dev_efscore
+            self.best_fscore = dev_efscore.efscore
+            self.best_model_path = "{}_Edev={:.4}".format(
+                self.args.model_path_base, dev_efscore.efscore)
+            self.best_processed = total_processed
+            print(" Saving new best model to {}...".format(self.best_model_path), flush=True)
+            torch.save({
+                   'spec': self.parser.spec,
+                   'state_dict': self.parser.state_dict(),
+                   'trainer' : self.trainer.state_dict(),
+                      }, self.best_model_path + ".pt")
+            if self.parser.bert is not None:
+                self.parser.save_bert_files(self.best_model_path + ".pt")
+
+        return dev_efscore
+
+def run_train(args, hparams):
+    import torch
+    import parse_nk
+    tokens = parse_nk
+
+    rank, world_size = 0, 1
+    if args.distributed:
+        import distributed
+        rank, world_size = distributed.init()
+        print("Process {} of {}".format(rank, world_size), flush=True)
+        if rank != 0:
+            # Only rank 0 reports progress
+            sys.stdout = open(os.devnull, 'w')
+        if args.numpy_seed is None:
+            # All processes need the same seed, to form the same batches
+            args.numpy_seed = distributed.broadcast_object(np.random.randint(2147483648))
+
+    if args.numpy_seed is not None:
+        print("Setting numpy random seed to {}...".format(args.numpy_seed))
+        np.random.seed(args.numpy_seed)
+
+    # Make sure that pytorch is actually being initialized randomly.
+    # On my cluster I was getting highly correlated results from multiple
+    # runs, but calling reset_parameters() changed that. A brief look at the
+    # pytorch source code revealed that pytorch initializes its RNG by
+    # calling std::random_device, which according to the C++ spec is allowed
+    # to be deterministic.
+    seed_from_numpy = np.random.randint(2147483648)
+    print("Manual seed for pytorch:", seed_from_numpy)
+    torch.manual_seed(seed_from_numpy)
+
+    hparams.set_from_args(args)
+    print("Hyperparameters:")
+    hparams.print()
+
+    print("Loading gold training trees from {}...".format(args.gold_train_path)) 
+    print("Loading silver training trees from {}...".format(args.silver_train_path))
+    if hparams.predict_tags and args.train_path.endswith('10way.clean'):
+        print("WARNING: The data distributed with this repository contains "
+              "predicted part-of-speech tags only (not gold tags!) We do not "
+              "recommend enabling predict_tags in this configuration.")
+    gold_train_treebank = trees.load_trees(args.gold_train_path)
+    silver_train_treebank = trees.load_trees(args.silver_train_path)
+    
+    new_batch_size = int(args.batch_size * ((10-args.silver_weight)/10)) 
+    silver_batch_size = int(args.batch_size - new_batch_size)
+
+    if hparams.max_len_train > 0:
+        gold_train_treebank = [tree for tree in gold_train_treebank if len(list(tree.leaves())) <= hparams.max_len_train]
+        silver_train_treebank = [tree for tree in silver_train_treebank if len(list(tree.leaves())) <= hparams.max_len_train]
+        if int(silver_batch_size*(len(gold_train_treebank)/new_batch_size))+1 < len(silver_train_treebank):
+            silver_train_treebank = silver_train_treebank[:int(silver_batch_size*(len(gold_train_treebank)/new_batch_size))+1]
+
+    print("Loaded {:,} gold training examples.".format(len(gold_train_treebank)))
+    print("Loaded {:,} silver training examples.".format(len(silver_train_treebank)))
+
+    print("Loading development trees from {}...".format(args.dev_path))
+    dev_treebank = trees.load_trees(args.dev_path)
+    if hparams.max_len_dev > 0:
+        dev_treebank = [tree for tree in dev_treebank if len(list(tree.leaves())) <= hparams.max_len_dev]
+    print("Loaded {:,} development examples.".format(len(dev_treebank)))
+
+    print("Processing gold trees for training...")
+    gold_train_parse = [tree.convert() for tree in gold_train_treebank]
+
+    print("Processing silver trees for training...")
+    silver_train_parse = [tree.convert() for tree in silver_train_treebank]
+
+    train_parse = gold_train_parse + silver_train_parse
+
+    print("Constructing vocabularies...")
+    tag_vocab, word_vocab, label_vocab, char_vocab = build_vocabularies(train_parse)
+
     def print_vocabulary(name, vocab):
         special = {tokens.START, tokens.STOP, tokens.UNK}
         print("{} ({:,}): {}".format(
@@ -227,6 +453,8 @@ def run_train(args, hparams):
             char_vocab,
             hparams,
         )
+    if world_size > 1:
+        distributed.broadcast_parameters(parser)
 
     print("Initializing optimizer...")
     trainable_parameters = [param for param in parser.parameters() if param.requires_grad]
@@ -234,96 +462,59 @@ def run_train(args, hparams):
     if args.train_load_path is not None:
         trainer.load_state_dict(info['trainer'])
 
-    def set_lr(new_lr):
-        for param_group in trainer.param_groups:
-            param_group['lr'] = new_lr
-
-    assert hparams.step_decay, "Only step_decay schedule is supported"
-
-    warmup_coeff = hparams.learning_rate / hparams.learning_rate_warmup_steps
-    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-        trainer, 'max',
-        factor=hparams.step_decay_factor,
-        patience=hparams.step_decay_patience,
-        verbose=True,
-    )
-    def schedule_lr(iteration):
-        iteration = iteration + 1
-        if iteration <= hparams.learning_rate_warmup_steps:
-            set_lr(iteration * warmup_coeff)
+    lr_schedule = LRSchedule(trainer, hparams)
 
     clippable_parameters = trainable_parameters
     grad_clip_threshold = np.inf if hparams.clip_grad_norm == 0 else hparams.clip_grad_norm
+    subbatch_max_bytes = args.subbatch_max_mb * 2**20 if args.subbatch_max_mb is not None else None
+
+    if args.elmo_features is not None:
+        import feature_store
+        assert parser.elmo is not None, "--elmo-features requires use_elmo"
+        print("Using ELMo features from {}".format(args.elmo_features))
+        parser.elmo_features = feature_store.FeatureStore(args.elmo_features)
+        assert parser.elmo_features.description == parse_nk.ELMO_FEATURES_DESCRIPTION, \
+            "{} holds {!r}, not features of {}; rerun precompute-elmo".format(
+                args.elmo_features, parser.elmo_features.description, parse_nk.ELMO_WEIGHT_FILE)
+
+    # Rank 0 writes the caches below, and the other ranks then read them
+    if rank != 0:
+        distributed.barrier()
+
+    if parser.bert is not None and args.wordpiece_files:
+        import wordpiece_cache
+        dataset_sentences = {}
+        for path, treebank in [(args.gold_train_path, gold_train_parse), (args.silver_train_path, silver_train_parse), (args.dev_path, dev_treebank)]:
+            dataset_sentences.setdefault(path, []).extend([(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in treebank)
+        for path, sentences in dataset_sentences.items():
+            print("Using wordpieces from {}".format(wordpiece_cache.add_dataset(parser, sentences, path)))
+
+    if parser.bert is not None and hparams.bert_freeze_layers > 0:
+        add_bert_frozen_features(parser, args,
+            [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in gold_train_parse + silver_train_parse + dev_treebank])
+
+    if world_size > 1 and rank == 0:
+        distributed.barrier()
+
+    # Encoder lengths, for length bucketing and for measuring padding
+    gold_lengths = parser.sentence_lengths([[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in gold_train_parse])
+    silver_lengths = parser.sentence_lengths([[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in silver_train_parse])
+    tree_lengths = {id(tree): length for tree, length in zip(gold_train_parse + silver_train_parse, gold_lengths + silver_lengths)}
 
     print("Training...")
     total_processed = 0
     current_processed = 0
     check_every = len(gold_train_parse) / args.checks_per_epoch
-    best_dev_fscore = -np.inf
-    best_dev_model_path = None
-    best_dev_processed = 0
-    best_dev_efscore = None
-
     start_time = time.time()
 
-    def check_dev():
-        nonlocal best_dev_fscore
-        nonlocal best_dev_model_path
-        nonlocal best_dev_processed
-        nonlocal best_dev_efscore 
-
-        dev_start_time = time.time()
-
-        dev_predicted = []
-        for dev_start_index in range(0, len(dev_treebank), args.eval_batch_size):
-            subbatch_trees = dev_treebank[dev_start_index:dev_start_index+args.eval_batch_size]
-            subbatch_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in subbatch_trees]
-            predicted, _ = parser.parse_batch(subbatch_sentences)
-            del _
-            dev_predicted.extend([p.convert() for p in predicted])
-
-        dev_fscore = evaluate.evalb(args.evalb_dir, dev_treebank, dev_predicted)        
-        dev_efscore = evaluate_EDITED.Evaluate(dev_treebank, dev_predicted)
-
-        print(
-            "dev-fscore {} "
-            "dev_efscore {}"
-            "dev-elapsed {} "
-            "total-elapsed {}".format(
-                dev_fscore,
-                dev_efscore,    
-                format_elapsed(dev_start_time),
-                format_elapsed(start_time)),   flush=True
-        )
-        # MJ - keep model with best efscore
-        if dev_efscore.efscore > best_dev_fscore:
-            if best_dev_model_path is not None:
-                extensions = [".pt"]
-                for ext in extensions:
-                    path = best_dev_model_path + ext
-                    if os.path.exists(path):
-                        print(" Removing previous model file {}...".format(path), flush=True)
-                        os.remove(path)
-            best_dev_efscore = dev_efscore
-            best_dev_fscore = dev_efscore.efscore
-            best_dev_model_path = "{}_Edev={:.4}".format(
-                args.model_path_base, dev_efscore.efscore)
-            best_dev_processed = total_processed
-            print(" Saving new best model to {}...".format(best_dev_model_path), flush=True)
-            torch.save({
-                   'spec': parser.spec,
-                   'state_dict': parser.state_dict(),
-                   'trainer' : trainer.state_dict(),
-                      }, best_dev_model_path + ".pt") 
+    dev_checker = DevChecker(args, parser, trainer, dev_treebank, start_time)
 
-        return dev_efscore
-            
     def check_hurdle(epoch, hurdle):
-        if best_dev_fscore < hurdle:
+        if dev_checker.best_fscore < hurdle:
             message = ("FAILURE: Epoch {} hurdle failed, stopping now!\n"
-                       "best_dev_fscore = {} < epoch{}_hurdle = {}".format(epoch, best_dev_fscore, epoch, hurdle))
+                       "best_dev_fscore = {} < epoch{}_hurdle = {}".format(epoch, dev_checker.best_fscore, epoch, hurdle))
             print(message, flush=True)
-            if args.results_path:
+            if args.results_path and rank == 0:
                 print(message, file=open(args.results_path, 'w'), flush=True)
             sys.exit(message)
 
@@ -331,24 +522,68 @@ def run_train(args, hparams):
         if args.epochs is not None and epoch > args.epochs:
             break
 
-        np.random.shuffle(gold_train_parse)
-        np.random.shuffle(silver_train_parse)
         epoch_start_time = time.time()
-        silver_start_index = 0
-        for start_index in range(0, len(gold_train_parse), new_batch_size):
+        if world_size > 1:
+            # The same batches on every rank, but different word dropout
+            epoch_seed = distributed.broadcast_object(np.random.randint(2147483648))
+            np.random.seed(epoch_seed)
+        if args.bucket_batches > 0:
+            epoch_batches = [
+                ([gold_train_parse[i] for i in gold_batch], [silver_train_parse[i] for i in silver_batch])
+                for gold_batch, silver_batch in batching.pair_batches(
+                    batching.make_bucketed_batches(gold_lengths, new_batch_size, args.bucket_batches), gold_lengths,
+                    batching.make_bucketed_batches(silver_lengths, silver_batch_size, args.bucket_batches) if silver_batch_size > 0 else [],
+                    silver_lengths)
+            ]
+        else:
+            np.random.shuffle(gold_train_parse)
+            np.random.shuffle(silver_train_parse)
+            epoch_batches = []
+            silver_start_index = 0
+            for start_index in range(0, len(gold_train_parse), new_batch_size):
+                gold_batch_trees = gold_train_parse[start_index:start_index + new_batch_size]
+                silver_batch_trees = silver_train_parse[silver_start_index*silver_batch_size:(silver_start_index*silver_batch_size) + silver_batch_size]
+                epoch_batches.append((gold_batch_trees, silver_batch_trees))
+                silver_start_index += 1
+                if (silver_start_index*silver_batch_size) + silver_batch_size > len(silver_train_parse)-silver_batch_size: silver_start_index = 0
+        if world_size > 1:
+            np.random.seed((epoch_seed + 1 + rank) % 2**32)
+
+        def prepare_epoch():
+            # Forms each batch and its sub-batches, with the network inputs
+            # of each sub-batch already built (see prefetch.Prefetcher)
+            for gold_batch_trees, silver_batch_trees in epoch_batches:
+                batch_trees = gold_batch_trees + silver_batch_trees
+                # Each rank trains on its share of the gold and silver trees
+                shard_trees = gold_batch_trees[rank::world_size] + silver_batch_trees[rank::world_size]
+                shard_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in shard_trees]
+                subbatches = [
+                    (subbatch_sentences, subbatch_trees, parser.prepare_batch(subbatch_sentences, is_train=True))
+                    for subbatch_sentences, subbatch_trees in parser.split_batch(shard_sentences, shard_trees, args.subbatch_max_tokens, subbatch_max_bytes)
+                ]
+                yield batch_trees, sum(len(list(tree.leaves())) for tree in batch_trees), subbatches
+
+        # All training-time numpy randomness (word dropout) happens in
+        # prepare_epoch, so prefetching does not change the random draws
+        if args.prefetch_batches > 0:
+            prefetcher = prefetch.Prefetcher(prepare_epoch(), args.prefetch_batches)
+            epoch_prepared = iter(prefetcher)
+        else:
+            prefetcher = None
+            epoch_prepared = prepare_epoch()
+
+        epoch_real_tokens = 0
+        epoch_padded_tokens = 0
+        for batch_trees, batch_num_tokens, subbatches in epoch_prepared:
             trainer.zero_grad()
-            schedule_lr(total_processed // new_batch_size)
+            lr_schedule.warmup(total_processed // new_batch_size)
 
             batch_loss_value = 0.0
-            gold_batch_trees = gold_train_parse[start_index:start_index + new_batch_size]
-            silver_batch_trees = silver_train_parse[silver_start_index*silver_batch_size:(silver_start_index*silver_batch_size) + silver_batch_size]
-            batch_trees = gold_batch_trees + silver_batch_trees
-            batch_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in batch_trees]
-            batch_num_tokens = sum(len(sentence) for sentence in batch_sentences)
-            silver_start_index += 1
-            if (silver_start_index*silver_batch_size) + silver_batch_size > len(silver_train_parse)-silver_batch_size: silver_start_index = 0        
-            for subbatch_sentences, subbatch_trees in parser.split_batch(batch_sentences, batch_trees, args.subbatch_max_tokens):
-                _, loss = parser.parse_batch(subbatch_sentences, subbatch_trees)
+            for subbatch_sentences, subbatch_trees, prepared in subbatches:
+                _, loss = parser.parse_batch(subbatch_sentences, subbatch_trees, prepared=prepared)
+                subbatch_lengths = [tree_lengths[id(tree)] for tree in subbatch_trees]
+                epoch_real_tokens += sum(subbatch_lengths)
+                epoch_padded_tokens += len(subbatch_lengths) * max(subbatch_lengths)
 
                 if hparams.predict_tags:
                     loss = loss[0] / len(batch_trees) + loss[1] / batch_num_tokens
@@ -359,9 +594,10 @@ def run_train(args, hparams):
                 if loss_value > 0:
                     loss.backward()
                 del loss
-                total_processed += len(subbatch_trees)
-                current_processed += len(subbatch_trees)
-                #print ("total-processed {} " "current-processed {}" .format(total_processed, current_processed))
+            total_processed += len(batch_trees)
+            current_processed += len(batch_trees)
+            if world_size > 1:
+                distributed.all_reduce_gradients(trainable_parameters)
             grad_norm = torch.nn.utils.clip_grad_norm_(clippable_parameters, grad_clip_threshold)
 
             trainer.step()
@@ -370,10 +606,20 @@ def run_train(args, hparams):
   
             if current_processed >= check_every:
                 current_processed -= check_every
-                dev_efscore = check_dev()
+                if rank == 0:
+                    dev_efscore = dev_checker.check(total_processed)
+                if world_size > 1:
+                    dev_checker.best_fscore, dev_checker.best_processed = distributed.broadcast_object(
+                        (dev_checker.best_fscore, dev_checker.best_processed))
                    
-        assert dev_efscore, "dev_efscore unbound, is checks_per_epoch >= 1?"
-        print ("epoch {:,} " "total-processed {} " "current-processed {}" .format(epoch, total_processed, current_processed))
+        assert rank != 0 or dev_efscore, "dev_efscore unbound, is checks_per_epoch >= 1?"
+        print ("epoch {:,} " "total-processed {} " "current-processed {} " "padding-ratio {:.3f} " "epoch-elapsed {}" .format(
+            epoch, total_processed, current_processed,
+            1.0 - epoch_real_tokens / max(epoch_padded_tokens, 1), format_elapsed(epoch_start_time)))
+        if prefetcher is not None:
+            prefetch_stats = prefetcher.stats()
+            print("prefetch-stall {:.1f}s mean-queue-depth {:.2f}".format(
+                prefetch_stats['stall_time'], prefetch_stats['mean_queue_depth']))
         if epoch == 1:
             check_hurdle(epoch, args.epoch1_hurdle)
         elif epoch == 10:
@@ -381,43 +627,42 @@ def run_train(args, hparams):
             
         
         # adjust learning rate at the end of an epoch
-        if (total_processed // new_batch_size + 1) > hparams.learning_rate_warmup_steps:
-            scheduler.step(dev_efscore.efscore)
-            if (total_processed - best_dev_processed) > ((hparams.step_decay_patience + 1) * hparams.max_consecutive_decays * len(gold_train_parse)):
+        if lr_schedule.warmup_done(total_processed // new_batch_size):
+            if rank == 0:
+                lr_schedule.step(dev_efscore.efscore)
+            if world_size > 1:
+                lr_schedule.set_lr(distributed.broadcast_object(trainer.param_groups[0]['lr']))
+            if lr_schedule.exhausted(total_processed - dev_checker.best_processed, len(gold_train_parse)):
                 print("Terminating due to lack of improvement in dev fscore.")
                 break
 
-    assert best_dev_efscore, "best_dev_efscore not set; did you train for at least 1 epoch?"
+    if rank != 0:
+        return
+    assert dev_checker.best_efscore, "best_dev_efscore not set; did you train for at least 1 epoch?"
     if args.results_path:
         outf = open(args.results_path, 'w')
-        print(best_dev_efscore.table(), file=outf, flush=True)
+        print(dev_checker.best_efscore.table(), file=outf, flush=True)
     else:
-        print(best_dev_efscore.table(), flush=True)
+        print(dev_checker.best_efscore.table(), flush=True)
         
 
 
 def run_test(args):
+    import parse_nk
+
     print("Loading test trees from {}...".format(args.test_path))
     test_treebank = trees.load_trees(args.test_path)
     print("Loaded {:,} test examples.".format(len(test_treebank)))
 
     print("Loading model from {}...".format(args.model_path_base))
-    assert args.model_path_base.endswith(".pt"), "Only pytorch savefiles supported"
-
-    info = torch_load(args.model_path_base)
-    assert 'hparams' in info['spec'], "Older savefiles not supported"
-    parser = parse_nk.NKChartParser.from_spec(info['spec'], info['state_dict'])
+    parser = load_parser(args.model_path_base)
 
     print("Parsing test sentences...")
     start_time = time.time()
 
-    test_predicted = []
-    for start_index in range(0, len(test_treebank), args.eval_batch_size):
-        subbatch_trees = test_treebank[start_index:start_index+args.eval_batch_size]
-        subbatch_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in subbatch_trees]
-        predicted, _ = parser.parse_batch(subbatch_sentences)
-        del _
-        test_predicted.extend([p.convert() for p in predicted])
+    test_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in test_treebank]
+    with parse_nk.precision_context(args.precision):
+        test_predicted = batching.parse_sentences(parser, test_sentences, **eval_batch_limits(args))
 
     # The tree loader does some preprocessing to the trees (e.g. stripping TOP
     # symbols or SPMRL morphological features). We compare with the input file
@@ -433,17 +678,22 @@ def run_test(args):
         ref_gold_path = args.test_path_raw
 
     test_fscore = evaluate.evalb(args.evalb_dir, test_treebank, test_predicted, ref_gold_path=ref_gold_path)
+    test_efscore = evaluate_EDITED.Evaluate(test_treebank, test_predicted)
 
     print(
         "test-fscore {} "
+        "test-efscore {} "
         "test-elapsed {}".format(
             test_fscore,
+            test_efscore,
             format_elapsed(start_time),
         )
     )
 
 #%%
 def run_ensemble(args):
+    import ensemble
+
     print("Loading test trees from {}...".format(args.test_path))
     test_treebank = trees.load_trees(args.test_path)
     print("Loaded {:,} test examples.".format(len(test_treebank)))
@@ -451,98 +701,617 @@ def run_ensemble(args):
     parsers = []
     for model_path_base in args.model_path_base:
         print("Loading model from {}...".format(model_path_base))
-        assert model_path_base.endswith(".pt"), "Only pytorch savefiles supported"
-
-        info = torch_load(model_path_base)
-        assert 'hparams' in info['spec'], "Older savefiles not supported"
-        parser = parse_nk.NKChartParser.from_spec(info['spec'], info['state_dict'])
-        parsers.append(parser)
-
-    # Ensure that label scores charts produced by the models can be combined
-    # using simple averaging
-    ref_label_vocab = parsers[0].label_vocab
-    for parser in parsers:
-        assert parser.label_vocab.indices == ref_label_vocab.indices
+        parsers.append(load_parser(model_path_base))
+
+    if args.cascade:
+        import cascade
+        parser_ensemble = cascade.CascadeParser(parsers,
+            margin_threshold=args.margin_threshold, edited_margin_threshold=args.edited_margin_threshold,
+            threads_per_member=args.threads_per_member, precision=args.precision)
+        print("Cascade: {} parses every sentence, the ensemble parses uncertain ones".format(args.model_path_base[0]))
+        groups = parser_ensemble.ensemble.preprocessing_groups
+    else:
+        parser_ensemble = ensemble.ParserEnsemble(parsers, threads_per_member=args.threads_per_member, precision=args.precision)
+        groups = parser_ensemble.preprocessing_groups
+    print("{} models in {} preprocessing group(s)".format(len(parsers), len(groups)))
 
     print("Parsing test sentences...")
     start_time = time.time()
 
-    test_predicted = []
-    # Ensemble by averaging label score charts from different models
-    # We did not observe any benefits to doing weighted averaging, probably
-    # because all our parsers output label scores of around the same magnitude
-    for start_index in range(0, len(test_treebank), args.eval_batch_size):
-        subbatch_trees = test_treebank[start_index:start_index+args.eval_batch_size]
-        subbatch_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in subbatch_trees]
-
-        chart_lists = []
-        for parser in parsers:
-            charts = parser.parse_batch(subbatch_sentences, return_label_scores_charts=True)
-            chart_lists.append(charts)
-
-        subbatch_charts = [np.mean(list(sentence_charts), 0) for sentence_charts in zip(*chart_lists)]
-        predicted, _ = parsers[0].decode_from_chart_batch(subbatch_sentences, subbatch_charts)
-        del _
-        test_predicted.extend([p.convert() for p in predicted])
+    test_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in test_treebank]
+    # Batches are formed using the lengths from the first model
+    test_predicted = batching.parse_sentences(parsers[0], test_sentences, parse_fn=parser_ensemble.parse_batch, **eval_batch_limits(args))
+    test_elapsed = format_elapsed(start_time)
 
     test_fscore = evaluate.evalb(args.evalb_dir, test_treebank, test_predicted, ref_gold_path=args.test_path)
+    test_efscore = evaluate_EDITED.Evaluate(test_treebank, test_predicted)
 
     print(
         "test-fscore {} "
+        "test-efscore {} "
         "test-elapsed {}".format(
             test_fscore,
-            format_elapsed(start_time),
+            test_efscore,
+            test_elapsed,
         )
     )
 
-#%%
+    if args.cascade:
+        stats = parser_ensemble.stats()
+        print("escalated {:,} of {:,} sentences ({:.1%})".format(
+            stats['escalated'], stats['sentences'], stats['escalated_fraction']))
+        for name, margins in [("label", parser_ensemble.label_margins), ("EDITED", parser_ensemble.edited_margins)]:
+            margins = np.asarray(margins)
+            margins = margins[np.isfinite(margins)]
+            if len(margins):
+                print("{} margin percentiles (10/25/50/75/90): {}".format(
+                    name, " ".join("{:.2f}".format(m) for m in np.percentile(margins, [10, 25, 50, 75, 90]))))
+
+        if args.compare_ensemble:
+            print("Parsing test sentences with the full ensemble...")
+            start_time = time.time()
+            full_predicted = batching.parse_sentences(parsers[0], test_sentences,
+                parse_fn=parser_ensemble.ensemble.parse_batch, **eval_batch_limits(args))
+            full_elapsed = format_elapsed(start_time)
+            full_fscore = evaluate.evalb(args.evalb_dir, test_treebank, full_predicted, ref_gold_path=args.test_path)
+            full_efscore = evaluate_EDITED.Evaluate(test_treebank, full_predicted)
+            agreement = np.mean([cascade_tree.linearize() == full_tree.linearize()
+                for cascade_tree, full_tree in zip(test_predicted, full_predicted)])
+            print(
+                "ensemble-fscore {} "
+                "ensemble-efscore {} "
+                "ensemble-elapsed {} "
+                "tree-agreement {:.2%}".format(
+                    full_fscore,
+                    full_efscore,
+                    full_elapsed,
+                    agreement,
+                )
+            )
+
+    parser_ensemble.close()
+
+def run_distill(args, hparams):
+    import torch
+    import chart_store
+    import ensemble
+    import parse_cache
+    import parse_nk
 
-def run_parse(args):
-    if args.output_path != '-' and os.path.exists(args.output_path):
-        print("Error: output file already exists:", args.output_path)
-        return
+    if args.numpy_seed is not None:
+        print("Setting numpy random seed to {}...".format(args.numpy_seed))
+        np.random.seed(args.numpy_seed)
+    seed_from_numpy = np.random.randint(2147483648)
+    print("Manual seed for pytorch:", seed_from_numpy)
+    torch.manual_seed(seed_from_numpy)
 
-    print("Loading model from {}...".format(args.model_path_base))
-    assert args.model_path_base.endswith(".pt"), "Only pytorch savefiles supported"
+    hparams.set_from_args(args)
+    print("Student hyperparameters:")
+    hparams.print()
 
-    info = torch_load(args.model_path_base)
-    assert 'hparams' in info['spec'], "Older savefiles not supported"
-    parser = parse_nk.NKChartParser.from_spec(info['spec'], info['state_dict'])
+    teachers = []
+    for model_path_base in args.teacher_model_path_base:
+        print("Loading teacher model from {}...".format(model_path_base))
+        teachers.append(load_parser(model_path_base))
+    label_vocab = teachers[0].label_vocab
 
-    print("Parsing sentences...")
-    with open(args.input_path) as input_file:
-        sentences = input_file.readlines()
-    sentences = [sentence.split() for sentence in sentences]
+    print("Loading gold training trees from {}...".format(args.gold_train_path))
+    gold_train_treebank = trees.load_trees(args.gold_train_path)
+    silver_train_treebank = []
+    if args.silver_train_path is not None:
+        print("Loading silver training trees from {}...".format(args.silver_train_path))
+        silver_train_treebank = trees.load_trees(args.silver_train_path)
+    unlabeled_sentences = []
+    if args.unlabeled_path is not None:
+        print("Loading unlabeled sentences from {}...".format(args.unlabeled_path))
+        with open(args.unlabeled_path) as input_file:
+            unlabeled_sentences = [[(teachers[0].dummy_tag, word) for word in line.split()] for line in input_file if line.strip()]
+    if hparams.max_len_train > 0:
+        gold_train_treebank = [tree for tree in gold_train_treebank if len(list(tree.leaves())) <= hparams.max_len_train]
+        silver_train_treebank = [tree for tree in silver_train_treebank if len(list(tree.leaves())) <= hparams.max_len_train]
+        unlabeled_sentences = [sentence for sentence in unlabeled_sentences if len(sentence) <= hparams.max_len_train]
+    print("Loaded {:,} gold, {:,} silver and {:,} unlabeled training examples.".format(
+        len(gold_train_treebank), len(silver_train_treebank), len(unlabeled_sentences)))
 
-    # Tags are not available when parsing from raw text, so use a dummy tag
-    if 'UNK' in parser.tag_vocab.indices:
-        dummy_tag = 'UNK'
+    print("Loading development trees from {}...".format(args.dev_path))
+    dev_treebank = trees.load_trees(args.dev_path)
+    if hparams.max_len_dev > 0:
+        dev_treebank = [tree for tree in dev_treebank if len(list(tree.leaves())) <= hparams.max_len_dev]
+    print("Loaded {:,} development examples.".format(len(dev_treebank)))
+
+    gold_train_parse = [tree.convert() for tree in gold_train_treebank]
+    silver_train_parse = [tree.convert() for tree in silver_train_treebank]
+    # Silver trees only contribute their sentences: the teacher charts are
+    # their targets
+    train_sentences = [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in gold_train_parse + silver_train_parse]
+    num_tagged = len(train_sentences)
+    train_sentences += unlabeled_sentences
+    train_golds = gold_train_parse + [None] * (len(train_sentences) - len(gold_train_parse))
+
+    # Teacher charts are computed once and cached on disk; the key makes sure
+    # that a store is only reused for the same teachers and sentences
+    chart_path = args.chart_store_path or args.model_path_base + "-teacher-charts.json"
+    key = chart_store.store_key(
+        [parse_cache.model_fingerprint(teacher, args.precision) for teacher in teachers], train_sentences)
+    if chart_store.is_valid(chart_path, key):
+        print("Using teacher charts from {}".format(chart_path))
     else:
-        dummy_tag = parser.tag_vocab.value(0)
+        print("Computing teacher charts for {:,} sentences into {}...".format(len(train_sentences), chart_path))
+        chart_start_time = time.time()
+        teacher_ensemble = ensemble.ParserEnsemble(teachers, precision=args.precision)
+        writer = chart_store.ChartWriter(chart_path, key, [len(sentence) for sentence in train_sentences], label_vocab)
+        # The members run at once, so a batch is budgeted by the sum of the
+        # teachers' estimates, at the longest of their encoder lengths
+        lengths = np.max([teacher.sentence_lengths(train_sentences) for teacher in teachers], axis=0).tolist()
+        estimate_bytes = lambda batch_size, max_len: sum(
+            teacher.estimate_batch_bytes(batch_size, max_len) for teacher in teachers)
+        for batch in batching.make_batches(lengths, estimate_bytes=estimate_bytes, **eval_batch_limits(args)):
+            charts = teacher_ensemble.charts([train_sentences[i] for i in batch])
+            for i, chart in zip(batch, charts):
+                writer.write(i, chart)
+        writer.close()
+        teacher_ensemble.close()
+        print("Computed teacher charts in {}".format(format_elapsed(chart_start_time)))
+    teacher_store = chart_store.ChartStore(chart_path)
+    del teachers
+
+    print("Initializing student model...")
+    tag_vocab, word_vocab, _, char_vocab = build_vocabularies(gold_train_parse + silver_train_parse)
+    # The student shares the teachers' label vocabulary, so that chart
+    # columns line up
+    parser = parse_nk.NKChartParser(tag_vocab, word_vocab, label_vocab, char_vocab, hparams)
 
+    trainable_parameters = [param for param in parser.parameters() if param.requires_grad]
+    trainer = torch.optim.Adam(trainable_parameters, lr=1., betas=(0.9, 0.98), eps=1e-9)
+
+    lr_schedule = LRSchedule(trainer, hparams)
+
+    grad_clip_threshold = np.inf if hparams.clip_grad_norm == 0 else hparams.clip_grad_norm
+    subbatch_max_bytes = args.subbatch_max_mb * 2**20 if args.subbatch_max_mb is not None else None
+
+    print("Distilling...")
+    total_processed = 0
+    current_processed = 0
+    check_every = len(train_sentences) / args.checks_per_epoch
     start_time = time.time()
 
-    all_predicted = []
-    for start_index in range(0, len(sentences), args.eval_batch_size):
-        subbatch_sentences = sentences[start_index:start_index+args.eval_batch_size]
+    dev_checker = DevChecker(args, parser, trainer, dev_treebank, start_time)
 
-        subbatch_sentences = [[(dummy_tag, word) for word in sentence] for sentence in subbatch_sentences]
-        predicted, _ = parser.parse_batch(subbatch_sentences)
-        del _
+    order = np.arange(len(train_sentences))
+    for epoch in itertools.count(start=1):
+        if args.epochs is not None and epoch > args.epochs:
+            break
+
+        np.random.shuffle(order)
+        epoch_start_time = time.time()
+        epoch_chart_loss = 0.0
+        for start_index in range(0, len(order), args.batch_size):
+            trainer.zero_grad()
+            lr_schedule.warmup(total_processed // args.batch_size)
+
+            batch = order[start_index:start_index + args.batch_size]
+            batch_sentences = [train_sentences[i] for i in batch]
+            # Only gold and silver trees have real tags to train predict_tags on
+            batch_num_tokens = sum(len(train_sentences[i]) for i in batch if i < num_tagged)
+            for subbatch_sentences, subbatch in parser.split_batch(batch_sentences, batch, args.subbatch_max_tokens, subbatch_max_bytes):
+                subbatch_golds = [train_golds[i] for i in subbatch] if args.gold_loss_weight > 0 else None
+                _, (chart_loss, gold_loss, tag_loss) = parser.parse_batch(subbatch_sentences, subbatch_golds,
+                    teacher_charts=[teacher_store.rows(i) for i in subbatch], tagged=[i < num_tagged for i in subbatch])
+                loss = (chart_loss + args.gold_loss_weight * gold_loss) / len(batch)
+                if tag_loss is not None and batch_num_tokens > 0:
+                    loss = loss + tag_loss / batch_num_tokens
+                epoch_chart_loss += float(chart_loss)
+                loss.backward()
+                del loss
+                total_processed += len(subbatch)
+                current_processed += len(subbatch)
+            torch.nn.utils.clip_grad_norm_(trainable_parameters, grad_clip_threshold)
+            trainer.step()
+
+            if current_processed >= check_every:
+                current_processed -= check_every
+                dev_efscore = dev_checker.check(total_processed)
+
+        print("epoch {:,} chart-loss {:.4f} epoch-elapsed {}".format(
+            epoch, epoch_chart_loss / len(train_sentences), format_elapsed(epoch_start_time)), flush=True)
+
+        if lr_schedule.warmup_done(total_processed // args.batch_size):
+            lr_schedule.step(dev_efscore.efscore)
+            if lr_schedule.exhausted(total_processed - dev_checker.best_processed, len(train_sentences)):
+                print("Terminating due to lack of improvement in dev fscore.")
+                break
+
+    assert dev_checker.best_efscore, "best_dev_efscore not set; did you train for at least 1 epoch?"
+    print(dev_checker.best_efscore.table(), flush=True)
+
+def read_chart_sentences(args, parser):
+    if args.input_format == "trees":
+        return [[(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in trees.load_trees(args.input_path)]
+    # Charts are stored by line number, so every line must hold a sentence
+    sentences = []
+    with open(args.input_path) as input_file:
+        for line_num, line in enumerate(input_file, start=1):
+            assert line.strip(), "Line {} of {} is blank".format(line_num, args.input_path)
+            sentences.append([(parser.dummy_tag, word) for word in line.split()])
+    return sentences
+
+def run_dump_charts(args):
+    import chart_store
+    import parse_cache
+    import parse_nk
+
+    print("Loading model from {}...".format(args.model_path_base))
+    parser = load_parser(args.model_path_base)
+    sentences = read_chart_sentences(args, parser)
+    print("Writing charts for {:,} sentences to {}...".format(len(sentences), args.output_path))
+    start_time = time.time()
+
+    key = chart_store.store_key([parse_cache.model_fingerprint(parser, args.precision)], sentences)
+    writer = chart_store.ChartWriter(args.output_path, key, [len(sentence) for sentence in sentences], parser.label_vocab,
+        dtype=np.float16 if args.dtype == "float16" else np.float32, top_k=args.top_k, sentences=sentences)
+    with parse_nk.precision_context(args.precision):
+        for batch in batching.make_batches(parser.sentence_lengths(sentences),
+                estimate_bytes=parser.estimate_batch_bytes, **eval_batch_limits(args)):
+            charts = parser.parse_batch([sentences[i] for i in batch], return_label_scores_charts=True)
+            for i, chart in zip(batch, charts):
+                writer.write(i, chart)
+    writer.close()
+
+    num_bytes = sum(os.path.getsize(path) for path in [
+        chart_store.get_array_path(args.output_path), chart_store.get_array_path(args.output_path, ".labels.npy")]
+        if os.path.exists(path))
+    print("Wrote {:.1f} MB of charts in {}".format(num_bytes / 2**20, format_elapsed(start_time)))
+
+def run_combine_charts(args):
+    import chart_store
+    import parse_nk
+
+    stores = []
+    for chart_path in args.chart_paths:
+        print("Loading charts from {}...".format(chart_path), file=sys.stderr)
+        stores.append(chart_store.ChartStore(chart_path))
+
+    # The charts must cover the same sentences, and their columns must line up
+    label_vocab = stores[0].label_vocab
+    sentences = stores[0].sentences
+    assert sentences is not None, "Chart files must be written by dump-charts"
+    for store in stores[1:]:
+        assert store.label_vocab.indices == label_vocab.indices, "Chart files have different label vocabularies"
+        # The scores of the labels outside the top k are made up on reading,
+        # so averaging them with other charts would be meaningless
+        assert stores[0].top_k is None and store.top_k is None, "Chart files written with --top-k cannot be combined"
+        assert [[word for _, word in sentence] for sentence in store.sentences] == [[word for _, word in sentence] for sentence in sentences], \
+            "Chart files are for different sentences"
+
+    start_time = time.time()
+    predicted = []
+    # Members are added in a fixed order, as in ensemble.ParserEnsemble
+    for index, sentence in enumerate(sentences):
+        chart = stores[0].chart(index)
+        for store in stores[1:]:
+            chart += store.chart(index)
+        chart /= len(stores)
+        tree, _ = parse_nk.decode_chart(sentence, chart, label_vocab)
+        predicted.append(tree.convert())
+    print("Combined {} chart file(s) for {:,} sentences in {}".format(
+        len(stores), len(sentences), format_elapsed(start_time)), file=sys.stderr)
+
+    if args.output_path is not None:
+        output = "".join("{}\n".format(tree.linearize()) for tree in predicted)
         if args.output_path == '-':
-            for p in predicted:
-                print(p.convert().linearize())
+            sys.stdout.write(output)
         else:
-            all_predicted.extend([p.convert() for p in predicted])
+            with open(args.output_path, 'w') as output_file:
+                output_file.write(output)
+
+    if args.test_path is not None:
+        test_treebank = trees.load_trees(args.test_path)
+        test_fscore = evaluate.evalb(args.evalb_dir, test_treebank, predicted, ref_gold_path=args.test_path)
+        test_efscore = evaluate_EDITED.Evaluate(test_treebank, predicted)
+        print(
+            "test-fscore {} "
+            "test-efscore {}".format(
+                test_fscore,
+                test_efscore,
+            ), file=sys.stderr
+        )
 
+def run_precompute_elmo(args):
+    import torch
+    import feature_store
+    import parse_nk
+
+    sentences = []
+    for input_path in args.input_paths:
+        print("Loading trees from {}...".format(input_path))
+        sentences.extend([(leaf.tag, leaf.word) for leaf in tree.leaves()] for tree in trees.load_trees(input_path))
+    # Identical sentences are stored once
+    sentences = list({feature_store.sentence_key(sentence): sentence for sentence in sentences}.values())
+    print("Running ELMo on {:,} distinct sentences...".format(len(sentences)))
+    start_time = time.time()
+
+    bilm = parse_nk.get_elmo_bilm()
+    if parse_nk.use_cuda:
+        bilm.cuda()
+    bilm.eval()
+    num_layers = bilm.num_layers
+    writer = feature_store.FeatureWriter(args.output_path, sentences,
+        # The stored rows include the sentence start and end positions
+        [len(sentence) + 2 for sentence in sentences], (num_layers, bilm.get_output_dim()),
+        dtype=np.float16 if args.dtype == "float16" else np.float32,
+        description=parse_nk.ELMO_FEATURES_DESCRIPTION)
+    with torch.no_grad():
+        for batch in batching.make_batches([len(sentence) for sentence in sentences], max_sentences=args.batch_size):
+            char_idxs = parse_nk.from_numpy(parse_nk.elmo_batch_char_ids([sentences[i] for i in batch]))
+            activations = bilm(char_idxs)['activations']
+            for snum, i in enumerate(batch):
+                num_rows = len(sentences[i]) + 2
+                writer.write(i, torch.stack([layer[snum, :num_rows] for layer in activations], 1).cpu().numpy())
+    writer.close()
+    print("Stored ELMo features in {} ({})".format(args.output_path, format_elapsed(start_time)))
+
+#%%
+
+def read_sentence_batches(input_file, batch_size, end_offset=None):
+    """
+    Lazily reads one sentence per line from a binary file, starting at its
+    current position and stopping at end_offset (if given). Yields lists of
+    up to batch_size sentences, together with the file offset just past the
+    last line of each batch.
+    """
+    offset = input_file.tell()
+    sentences = []
+    while end_offset is None or offset < end_offset:
+        line = input_file.readline()
+        if not line:
+            break
+        offset += len(line)
+        sentences.append(line.decode('utf-8').split())
+        if len(sentences) == batch_size:
+            yield sentences, offset
+            sentences = []
+    if sentences:
+        yield sentences, offset
+
+def parse_raw_sentences(parser, sentences, cache=None, **batch_limits):
+    """
+    Parses tokenized raw sentences in length-sorted batches and returns the
+    linearized trees, one per line in input order
+    """
+    # Tags are not available when parsing from raw text
+    dummy_tag = parser.dummy_tag
+    predicted = batching.parse_sentences(parser, [[(dummy_tag, word) for word in sentence] for sentence in sentences],
+        cache=cache, **batch_limits)
+    return "".join("{}\n".format(p.linearize()) for p in predicted)
+
+def run_parse(args):
+    import parse_nk
+
+    # Progress is recorded after every batch, so that an interrupted job can
+    # resume where it stopped instead of starting over
+    progress_path = args.output_path + ".progress"
+    progress = None
+    if args.output_path != '-' and os.path.exists(args.output_path):
+        if not os.path.exists(progress_path):
+            print("Error: output file already exists:", args.output_path)
+            return
+        with open(progress_path) as progress_file:
+            progress = json.load(progress_file)
+        if progress['input_path'] != args.input_path:
+            print("Error: {} was written for a different input file: {}".format(args.output_path, progress['input_path']))
+            return
+        # Appending another model's output would silently mix the two
+        for name in ['model_path_base', 'precision']:
+            if progress.get(name) != getattr(args, name):
+                print("Error: {} was written with a different {}: {}".format(args.output_path, name, progress.get(name)))
+                return
+        print("Resuming after line {:,} of {}".format(progress['input_lines'], args.input_path))
+
+    print("Loading model from {}...".format(args.model_path_base))
+    parser = load_parser(args.model_path_base)
+    cache = make_parse_cache(args, parser)
+
+    print("Parsing sentences...")
+    start_time = time.time()
+
+    def save_progress():
+        with open(progress_path + ".tmp", 'w') as progress_file:
+            json.dump(progress, progress_file)
+        os.replace(progress_path + ".tmp", progress_path)
+
+    input_file = open(args.input_path, 'rb')
+    output_file = None
     if args.output_path != '-':
-        with open(args.output_path, 'w') as output_file:
-            for tree in all_predicted:
-                output_file.write("{}\n".format(tree.linearize()))
-        print("Output written to:", args.output_path)
+        if progress is None:
+            progress = dict(input_path=args.input_path, model_path_base=args.model_path_base, precision=args.precision,
+                input_offset=0, input_lines=0, output_offset=0)
+            # Written before the output, so that a crash in the first window
+            # can still be resumed
+            save_progress()
+            output_file = open(args.output_path, 'wb')
+        else:
+            # Drop any output written after the last recorded batch
+            output_file = open(args.output_path, 'r+b')
+            output_file.truncate(progress['output_offset'])
+            output_file.seek(progress['output_offset'])
+            input_file.seek(progress['input_offset'])
+
+    def write_output(sentences, input_offset, output):
+        if output_file is None:
+            print(output, end='', flush=True)
+            return
+
+        output_file.write(output.encode('utf-8'))
+        output_file.flush()
+        progress['input_offset'] = input_offset
+        progress['input_lines'] += len(sentences)
+        progress['output_offset'] = output_file.tell()
+        save_progress()
+
+    with input_file:
+        windows = read_sentence_batches(input_file, args.sort_window)
+        if args.pipeline:
+            import parse_pipeline
+            stages, elapsed = parse_pipeline.parse_pipelined(
+                parser, windows, write_output, precision=args.precision, cache=cache, **eval_batch_limits(args))
+            # Progress messages go to stderr when the output is written to stdout
+            log_file = sys.stderr if output_file is None else sys.stdout
+            for stage in stages:
+                print("stage {:<8} batches {:,} busy {:.1f}s utilization {:.1%}".format(
+                    stage.name, stage.num_items, stage.busy_time, stage.busy_time / elapsed), file=log_file)
+        else:
+            with parse_nk.precision_context(args.precision):
+                for sentences, input_offset in windows:
+                    write_output(sentences, input_offset, parse_raw_sentences(parser, sentences, cache=cache, **eval_batch_limits(args)))
+
+    if cache is not None:
+        print("Parse cache:", cache.stats(), file=sys.stderr if output_file is None else sys.stdout)
+        cache.close()
+
+    if output_file is not None:
+        output_file.close()
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        print("Output written to: {} ({:,} sentences, {})".format(
+            args.output_path, progress['input_lines'], format_elapsed(start_time)))
+
+def run_parse_corpus(args):
+    import parse_corpus
+
+    input_paths = parse_corpus.get_input_paths(args.input_path)
+    shard_dir = os.path.join(args.output_dir, "shards")
+    manifest_path = os.path.join(args.output_dir, "manifest.json")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    print("Splitting {:,} input file(s) into shards of {:,} lines...".format(len(input_paths), args.shard_lines))
+    shards = parse_corpus.find_shards(input_paths, args.shard_lines)
+    manifest = dict(
+        input_paths=input_paths,
+        shard_lines=args.shard_lines,
+        num_shards=len(shards),
+        model_path_base=args.model_path_base,
+        precision=args.precision,
+        completed={},
+    )
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            old_manifest = json.load(f)
+        for key in ['input_paths', 'shard_lines', 'num_shards', 'model_path_base', 'precision']:
+            if old_manifest.get(key) != manifest[key]:
+                print("Error: {} has a different {}: {}".format(manifest_path, key, old_manifest.get(key)))
+                return
+        manifest['completed'] = {
+            shard_id: num_lines for shard_id, num_lines in old_manifest['completed'].items()
+            if os.path.exists(os.path.join(shard_dir, shard_id + ".txt"))
+        }
+    parse_corpus.save_manifest(manifest_path, manifest)
+
+    pending = [shard for shard in shards if shard['id'] not in manifest['completed']]
+    print("{:,} shards, {:,} already done".format(len(shards), len(shards) - len(pending)))
+
+    start_time = time.time()
+    if args.threads_per_worker == 0:
+        args.threads_per_worker = max(1, len(os.sched_getaffinity(0)) // args.num_workers)
+    failed = parse_corpus.run_shards(args, pending, shard_dir, manifest, manifest_path)
+    if failed:
+        sys.exit("FAILURE: {:,} shard(s) failed after {} retries: {}. Rerun to retry them.".format(
+            len(failed), args.max_retries, ", ".join(shard['id'] for shard in failed)))
+
+    output_paths = parse_corpus.merge_shards(input_paths, shards, shard_dir, args.output_dir)
+    print("Output written to: {} ({})".format(", ".join(output_paths), format_elapsed(start_time)))
+
 #%%
 
+def run_serve(args):
+    import signal
+    import torch
+    import parse_nk
+    import parse_server
+
+    if args.num_workers > 1:
+        assert not parse_nk.use_cuda, "Multiple workers are only supported for CPU inference"
+        # Keep the parent single-threaded: an OpenMP thread pool that is
+        # already running when the workers are forked can deadlock them
+        torch.set_num_threads(1)
+
+    print("Loading model from {}...".format(args.model_path_base))
+    parser = load_parser(args.model_path_base)
+
+    # Hashing reads every weight, so it is done once here rather than in each
+    # forked worker
+    fingerprint = None
+    if args.parse_cache_size > 0:
+        import parse_cache
+        fingerprint = parse_cache.model_fingerprint(parser, args.precision)
+
+    def make_batcher():
+        # Each worker opens its own cache (and its own database connection)
+        return parse_server.MicroBatcher(
+            parser,
+            cache=make_parse_cache(args, parser, fingerprint),
+            max_batch_tokens=args.max_batch_tokens,
+            max_batch_bytes=args.max_batch_mb * 2**20 if args.max_batch_mb is not None else None,
+            max_batch_size=args.eval_batch_size,
+            max_wait=args.max_wait_ms / 1000,
+            precision=args.precision,
+        )
+
+    server = parse_server.make_server(socket_path=args.socket_path, host=args.host, port=args.port)
+    if args.socket_path is not None:
+        print("Listening on", args.socket_path, flush=True)
+    else:
+        print("Listening on {}:{}".format(args.host, args.port), flush=True)
+
+    # Shut down cleanly (removing the socket file) when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.num_workers > 1:
+            # Weights from a slim checkpoint are already in a shared memory map
+            if not args.model_path_base.endswith(".json"):
+                parse_server.share_parser_memory(parser)
+
+            def start_worker(worker_num, cpus):
+                os.sched_setaffinity(0, cpus)
+                torch.set_num_threads(args.threads_per_worker or len(cpus))
+                server.setup_parser(make_batcher(), parser.dummy_tag)
+                print("Worker {} (pid {}) using cpus {}".format(worker_num, os.getpid(), cpus), flush=True)
+
+            parse_server.serve_prefork(server, args.num_workers, start_worker)
+        else:
+            batcher = make_batcher()
+            server.setup_parser(batcher, parser.dummy_tag)
+            try:
+                server.serve_forever()
+            finally:
+                print("Server stats:", batcher.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket_path is not None and os.path.exists(args.socket_path):
+            os.remove(args.socket_path)
+
+def run_export_inference(args):
+    import slim_checkpoint
+
+    if os.path.exists(args.output_path):
+        print("Error: output file already exists:", args.output_path)
+        return
+
+    print("Loading model from {}...".format(args.model_path_base))
+    parser = load_parser(args.model_path_base)
+
+    print("Writing slim inference checkpoint to {}...".format(args.output_path))
+    slim_checkpoint.save(args.output_path, parser.spec, parser.state_dict())
+    if parser.bert is not None:
+        parser.save_bert_files(args.output_path)
+    print("Output written to: {} and {}".format(
+        args.output_path, slim_checkpoint.get_weights_path(args.output_path)))
+
 def run_viz(args):
+    import parse_nk
+    tokens = parse_nk
+
     assert args.model_path_base.endswith(".pt"), "Only pytorch savefiles supported"
 
     print("Loading test trees from {}...".format(args.viz_path))
@@ -550,11 +1319,7 @@ def run_viz(args):
     print("Loaded {:,} test examples.".format(len(viz_treebank)))
 
     print("Loading model from {}...".format(args.model_path_base))
-
-    info = torch_load(args.model_path_base)
-
-    assert 'hparams' in info['spec'], "Only self-attentive models are supported"
-    parser = parse_nk.NKChartParser.from_spec(info['spec'], info['state_dict'])
+    parser = load_parser(args.model_path_base)
 
     from viz import viz_attention
 
@@ -610,7 +1375,11 @@ def main():
     subparser.add_argument("--dev-path", default="swbd-data/autopos-nopunct-nopw/dev.txt")
     subparser.add_argument("--batch-size", type=int, default=250)
     subparser.add_argument("--subbatch-max-tokens", type=int, default=2000)
+    subparser.add_argument("--subbatch-max-mb", type=float, help="Maximum estimated activation memory per training sub-batch, in MB")
     subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
     subparser.add_argument("--epochs", type=int)
     subparser.add_argument("--checks-per-epoch", type=int, default=4)
     subparser.add_argument("--print-vocabs", action="store_true")
@@ -618,6 +1387,12 @@ def main():
     subparser.add_argument("--epoch10-hurdle", default=0.75, type=float, help="Stop training if epoch 10 efscore less than this value")
     subparser.add_argument("--results-path", default=None)
     subparser.add_argument("--silver-weight", default=4, type=int, help="Weights on using silver parse trees in each mini-batch") 
+    subparser.add_argument("--bert-frozen-cache", help="With --bert-freeze-layers, where the float16 output of the frozen BERT layers is stored (default: MODEL_PATH_BASE-bert-frozen.json)")
+    subparser.add_argument("--elmo-features", help="Feature store from precompute-elmo; sentences in it do not run the ELMo biLM")
+    subparser.add_argument("--wordpiece-files", action="store_true", help="For BERT models, store the tokenization of each treebank next to it (as PATH.wordpieces.npz) and reuse it")
+    subparser.add_argument("--prefetch-batches", type=int, default=2, help="Training batches prepared ahead in a background thread (0: prepare inline)")
+    subparser.add_argument("--bucket-batches", type=int, default=0, help="Group training trees by length, in buckets of this many batches (0: uniform random batches)")
+    subparser.add_argument("--distributed", action="store_true", help="Data-parallel training over the processes started by torchrun, with the gloo backend")
     subparser.add_argument("--train-load-path", required=True)
 
     subparser = subparsers.add_parser("test")
@@ -627,20 +1402,132 @@ def main():
     subparser.add_argument("--test-path", default="swbd-data/autopos-nopunct-nopw/test.tx")
     subparser.add_argument("--test-path-raw", type=str)
     subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the encoder and span scorer in bfloat16 autocast")
 
     subparser = subparsers.add_parser("ensemble")
     subparser.set_defaults(callback=run_ensemble)
     subparser.add_argument("--model-path-base", nargs='+', required=True)
     subparser.add_argument("--evalb-dir", default="EVALB/")
     subparser.add_argument("--test-path", default="swbd-data/autopos-nopunct-nopw/test.tx")
+    subparser.add_argument("--threads-per-member", type=int, help="torch threads per ensemble member (default: cpus / members)")
+    subparser.add_argument("--cascade", action="store_true", help="Parse with the first model, and only use the ensemble on sentences where its chart margins are small")
+    subparser.add_argument("--margin-threshold", type=float, default=1.0, help="Escalate when a span of the predicted tree has a best/second-best label score gap below this")
+    subparser.add_argument("--edited-margin-threshold", type=float, default=1.0, help="Escalate when any span's best EDITED and best other label scores are closer than this")
+    subparser.add_argument("--compare-ensemble", action="store_true", help="With --cascade, also parse with the full ensemble and report its scores and the tree agreement")
+    subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the encoder and span scorer in bfloat16 autocast")
+
+    subparser = subparsers.add_parser("distill")
+    subparser.set_defaults(callback=lambda args: run_distill(args, hparams))
+    hparams.populate_arguments(subparser)
+    subparser.add_argument("--numpy-seed", type=int)
+    subparser.add_argument("--teacher-model-path-base", nargs='+', required=True)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--evalb-dir", default="EVALB/")
+    subparser.add_argument("--gold-train-path", default="swbd-data/autopos-nopunct-nopw/train.txt")
+    subparser.add_argument("--silver-train-path", help="Trees whose sentences are added to the training data; only the teacher charts are used as targets")
+    subparser.add_argument("--unlabeled-path", help="Raw sentences, one per line, that are added to the training data")
+    subparser.add_argument("--dev-path", default="swbd-data/autopos-nopunct-nopw/dev.txt")
+    subparser.add_argument("--chart-store-path", help="Where teacher charts are cached (default: MODEL_PATH_BASE-teacher-charts.json)")
+    subparser.add_argument("--gold-loss-weight", type=float, default=0.0, help="Weight of the usual margin loss on gold trees, added to the chart loss")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the teachers in bfloat16 autocast")
+    subparser.add_argument("--batch-size", type=int, default=250)
+    subparser.add_argument("--subbatch-max-tokens", type=int, default=2000)
+    subparser.add_argument("--subbatch-max-mb", type=float, help="Maximum estimated activation memory per training sub-batch, in MB")
+    subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
+    subparser.add_argument("--epochs", type=int)
+    subparser.add_argument("--checks-per-epoch", type=int, default=4)
+
+    subparser = subparsers.add_parser("precompute-elmo")
+    subparser.set_defaults(callback=run_precompute_elmo)
+    subparser.add_argument("--input-paths", nargs='+', default=["swbd-data/autopos-nopunct-nopw/train.txt", "swbd-data/autopos-nopunct-nopw/dev.txt"])
+    subparser.add_argument("--output-path", required=True, help="Feature store to write, ending in .json (the features go in a .npy next to it)")
+    subparser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    subparser.add_argument("--batch-size", type=int, default=64)
+
+    subparser = subparsers.add_parser("dump-charts")
+    subparser.set_defaults(callback=run_dump_charts)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--input-path", type=str, required=True)
+    subparser.add_argument("--input-format", choices=["trees", "raw"], default="trees", help="Parse trees, or raw sentences one per line")
+    subparser.add_argument("--output-path", type=str, required=True, help="Chart file to write, ending in .json (the charts go in a .npy next to it)")
+    subparser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    subparser.add_argument("--top-k", type=int, help="Only keep the k highest-scoring labels of each span (such files can be decoded, but not combined with others)")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the encoder and span scorer in bfloat16 autocast")
     subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
+
+    subparser = subparsers.add_parser("combine-charts")
+    subparser.set_defaults(callback=run_combine_charts)
+    subparser.add_argument("--chart-paths", nargs='+', required=True)
+    subparser.add_argument("--output-path", type=str, default="-")
+    subparser.add_argument("--test-path", help="Gold trees of the sentences, to evaluate the combined parses")
+    subparser.add_argument("--evalb-dir", default="EVALB/")
 
     subparser = subparsers.add_parser("parse")
     subparser.set_defaults(callback=run_parse)
     subparser.add_argument("--model-path-base", required=True)
     subparser.add_argument("--input-path", type=str, required=True)
     subparser.add_argument("--output-path", type=str, default="-")
+    subparser.add_argument("--pipeline", action="store_true", help="Overlap tokenization, the encoder and decoding in separate threads")
+    subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
+    subparser.add_argument("--sort-window", type=int, default=2000, help="Number of input lines that are sorted by length and batched together")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the encoder and span scorer in bfloat16 autocast")
+    subparser.add_argument("--parse-cache-size", type=int, default=0, help="Cache the parses of up to this many distinct sentences in memory (0 disables the cache)")
+    subparser.add_argument("--parse-cache-path", type=str, help="SQLite file in which to keep cached parses between runs")
+
+    subparser = subparsers.add_parser("parse-corpus")
+    subparser.set_defaults(callback=run_parse_corpus)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--input-path", type=str, required=True, help="A file, or a directory of files, with one sentence per line")
+    subparser.add_argument("--output-dir", type=str, required=True)
+    subparser.add_argument("--shard-lines", type=int, default=10000)
+    subparser.add_argument("--num-workers", type=int, default=4)
+    subparser.add_argument("--threads-per-worker", type=int, default=0, help="torch threads per worker (default: cpus / workers)")
+    subparser.add_argument("--max-retries", type=int, default=2)
     subparser.add_argument("--eval-batch-size", type=int, default=100)
+    subparser.add_argument("--eval-batch-tokens", type=int, default=5000, help="Maximum padded tokens (batch size * longest length) per evaluation batch")
+    subparser.add_argument("--eval-batch-cost", type=int, help="Maximum attention cost (batch size * longest length ** 2) per evaluation batch")
+    subparser.add_argument("--eval-batch-mb", type=float, help="Maximum estimated activation memory per evaluation batch, in MB")
+    subparser.add_argument("--sort-window", type=int, default=2000, help="Number of input lines that are sorted by length and batched together")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the encoder and span scorer in bfloat16 autocast")
+    subparser.add_argument("--parse-cache-size", type=int, default=0, help="Cache the parses of up to this many distinct sentences in memory (0 disables the cache)")
+    subparser.add_argument("--parse-cache-path", type=str, help="SQLite file in which to keep cached parses between runs")
+
+    subparser = subparsers.add_parser("serve")
+    subparser.set_defaults(callback=run_serve)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--socket-path", type=str, help="Listen on this Unix socket instead of TCP")
+    subparser.add_argument("--host", type=str, default="127.0.0.1")
+    subparser.add_argument("--port", type=int, default=8765)
+    subparser.add_argument("--eval-batch-size", type=int, default=100, help="Maximum number of sentences per micro-batch")
+    subparser.add_argument("--max-batch-tokens", type=int, default=2000, help="Maximum padded tokens (batch size * longest length, in subwords for BERT) per micro-batch")
+    subparser.add_argument("--max-batch-mb", type=float, help="Maximum estimated activation memory per micro-batch, in MB")
+    subparser.add_argument("--max-wait-ms", type=float, default=5.0, help="Maximum time to wait for a micro-batch to fill up")
+    subparser.add_argument("--num-workers", type=int, default=1, help="Number of worker processes forked after loading the model")
+    subparser.add_argument("--threads-per-worker", type=int, default=0, help="torch threads per worker (default: the number of cpus assigned to it)")
+    subparser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32", help="Run the encoder and span scorer in bfloat16 autocast")
+    subparser.add_argument("--parse-cache-size", type=int, default=0, help="Cache the parses of up to this many distinct sentences in memory (0 disables the cache)")
+    subparser.add_argument("--parse-cache-path", type=str, help="SQLite file in which to keep cached parses between runs")
+
+    subparser = subparsers.add_parser("export-inference")
+    subparser.set_defaults(callback=run_export_inference)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--output-path", type=str, required=True, help="Path of the .json file; weights are written next to it as .bin")
 
     subparser = subparsers.add_parser("viz")
     subparser.set_defaults(callback=run_viz)
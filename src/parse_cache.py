@@ -0,0 +1,181 @@
+"""
+Exact-match cache of parse results, keyed on the (tag, word) tuple of a
+sentence. Conversational transcripts repeat the same short utterances
+("yeah", "uh-huh", "you know") very often, and a cache hit skips both the
+encoder and the decoder.
+
+Entries are kept in memory with least-recently-used eviction, and can also
+be persisted to a SQLite file so that they survive between runs. Every entry
+is stored under a fingerprint of the model (see model_fingerprint), so a
+cache file can be shared between models without ever serving results from a
+different one. Trees are stored on disk as JSON of their structure, since
+words may contain brackets that the linearized format cannot represent.
+"""
+
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+
+import trees
+
+def model_fingerprint(parser, precision="fp32"):
+    """
+    Hash of the hyperparameters, vocabularies and weights of a parser, and of
+    the precision it runs in
+    """
+    fingerprint = hashlib.sha1()
+    spec = {
+        'hparams': parser.spec['hparams'],
+        'precision': precision,
+    }
+    for name in ['tag_vocab', 'word_vocab', 'label_vocab', 'char_vocab']:
+        spec[name] = parser.spec[name].to_dict()
+    fingerprint.update(json.dumps(spec, sort_keys=True).encode('utf-8'))
+    for name, tensor in sorted(parser.state_dict().items()):
+        fingerprint.update(name.encode('utf-8'))
+        fingerprint.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return fingerprint.hexdigest()
+
+def tree_to_json(tree):
+    """
+    A tree as nested lists: [tag, word] for a leaf, and [label, [children]]
+    for an internal node
+    """
+    if isinstance(tree, trees.LeafTreebankNode):
+        return [tree.tag, tree.word]
+    return [tree.label, [tree_to_json(child) for child in tree.children]]
+
+def tree_from_json(value):
+    label, rest = value
+    if isinstance(rest, str):
+        return trees.LeafTreebankNode(label, rest)
+    return trees.InternalTreebankNode(label, [tree_from_json(child) for child in rest])
+
+class ParseCache:
+    def __init__(self, fingerprint, max_entries=100000, path=None):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        # Both the server's handler threads and its batching thread use the cache
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.duplicates = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS parses ("
+                "fingerprint TEXT, sentence TEXT, tree TEXT, "
+                "PRIMARY KEY (fingerprint, sentence))")
+            self.db.commit()
+
+    @staticmethod
+    def key(sentence):
+        return tuple(tuple(tag_word) for tag_word in sentence)
+
+    def add_to_memory(self, key, tree):
+        self.entries[key] = tree
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, sentence):
+        """
+        Returns the cached tree for a sentence, or None
+        """
+        key = self.key(sentence)
+        with self.lock:
+            tree = self.entries.get(key)
+            if tree is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tree
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT tree FROM parses WHERE fingerprint = ? AND sentence = ?",
+                    (self.fingerprint, json.dumps(key))).fetchone()
+                tree = None
+                if row is not None:
+                    # A row that cannot be read back (e.g. written in another
+                    # format) is a miss, and is replaced when the sentence is
+                    # parsed again
+                    try:
+                        tree = tree_from_json(json.loads(row[0]))
+                    except (ValueError, TypeError, AssertionError):
+                        pass
+                if tree is not None:
+                    self.add_to_memory(key, tree)
+                    self.disk_hits += 1
+                    return tree
+            self.misses += 1
+            return None
+
+    def put_many(self, sentences, predicted):
+        with self.lock:
+            for sentence, tree in zip(sentences, predicted):
+                self.add_to_memory(self.key(sentence), tree)
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO parses (fingerprint, sentence, tree) VALUES (?, ?, ?)",
+                    [(self.fingerprint, json.dumps(self.key(sentence)), json.dumps(tree_to_json(tree)))
+                     for sentence, tree in zip(sentences, predicted)])
+                self.db.commit()
+
+    def lookup(self, sentences):
+        """
+        Returns the cached tree for each sentence (None if it is not cached),
+        and the sentences that are not cached, as lists of the indices of
+        identical sentences
+        """
+        predicted = [self.get(sentence) for sentence in sentences]
+        missing = collections.OrderedDict()
+        for i, tree in enumerate(predicted):
+            if tree is None:
+                missing.setdefault(self.key(sentences[i]), []).append(i)
+        with self.lock:
+            # Only the first occurrence of a sentence counts as a miss
+            num_duplicates = sum(len(indices) - 1 for indices in missing.values())
+            self.duplicates += num_duplicates
+            self.misses -= num_duplicates
+        return predicted, list(missing.values())
+
+    def parse(self, sentences, parse_fn):
+        """
+        Returns the trees for sentences, calling parse_fn on the sentences that
+        are not in the cache. Identical sentences are only parsed once.
+        """
+        predicted, missing = self.lookup(sentences)
+        if not missing:
+            return predicted
+
+        missing_sentences = [sentences[indices[0]] for indices in missing]
+        missing_predicted = parse_fn(missing_sentences)
+        self.put_many(missing_sentences, missing_predicted)
+        for indices, tree in zip(missing, missing_predicted):
+            for i in indices:
+                predicted[i] = tree
+        return predicted
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses + self.duplicates
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'duplicates': self.duplicates,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits + self.duplicates) / max(lookups, 1),
+            }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
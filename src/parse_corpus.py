@@ -0,0 +1,132 @@
+"""
+Sharded parsing of large corpora with a pool of worker processes, each of
+which loads its own copy of the model.
+
+The input (a file, or a directory of files) is split into shards of a fixed
+number of lines. Each shard is parsed into <output-dir>/shards/<shard-id>.txt
+and recorded in <output-dir>/manifest.json once it is complete, so that
+rerunning the same command skips finished shards. When every shard is done,
+the shards of each input file are concatenated in their original order into
+<output-dir>/<input-name>.parsed.
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import shutil
+
+import main
+
+def get_input_paths(input_path):
+    if os.path.isdir(input_path):
+        return sorted(
+            os.path.join(input_path, name) for name in os.listdir(input_path)
+            if os.path.isfile(os.path.join(input_path, name)))
+    return [input_path]
+
+def find_shards(input_paths, shard_lines):
+    """
+    Splits each input file into byte ranges of shard_lines lines. Only line
+    boundaries are read here; no text is decoded.
+    """
+    shards = []
+    for file_num, input_path in enumerate(input_paths):
+        with open(input_path, 'rb') as input_file:
+            start = offset = 0
+            num_lines = 0
+            shard_num = 0
+            for line in input_file:
+                offset += len(line)
+                num_lines += 1
+                if num_lines == shard_lines:
+                    shards.append(dict(id="{:05d}-{:06d}".format(file_num, shard_num),
+                        input_path=input_path, start=start, end=offset, lines=num_lines))
+                    start = offset
+                    num_lines = 0
+                    shard_num += 1
+            if num_lines > 0:
+                shards.append(dict(id="{:05d}-{:06d}".format(file_num, shard_num),
+                    input_path=input_path, start=start, end=offset, lines=num_lines))
+    return shards
+
+def save_manifest(manifest_path, manifest):
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+# Per-process state of the pool workers
+worker_parser = None
+worker_args = None
+worker_cache = None
+
+def init_worker(args):
+    import torch
+    global worker_parser, worker_args, worker_cache
+    torch.set_num_threads(args.threads_per_worker)
+    worker_args = args
+    worker_parser = main.load_parser(args.model_path_base)
+    worker_cache = main.make_parse_cache(args, worker_parser)
+
+def parse_shard(shard, shard_path):
+    import parse_nk
+    tmp_path = shard_path + ".tmp"
+    with open(shard['input_path'], 'rb') as input_file, open(tmp_path, 'wb') as output_file:
+        input_file.seek(shard['start'])
+        with parse_nk.precision_context(worker_args.precision):
+            for sentences, _ in main.read_sentence_batches(input_file, worker_args.sort_window, end_offset=shard['end']):
+                output = main.parse_raw_sentences(worker_parser, sentences, cache=worker_cache, **main.eval_batch_limits(worker_args))
+                output_file.write(output.encode('utf-8'))
+    os.replace(tmp_path, shard_path)
+    return shard['id']
+
+def run_shards(args, shards, shard_dir, manifest, manifest_path):
+    """
+    Parses the given shards, retrying failed ones up to args.max_retries
+    times. Returns the shards that still failed.
+    """
+    attempts = {shard['id']: 0 for shard in shards}
+    pending = list(shards)
+    failed = []
+    mp_context = multiprocessing.get_context('spawn')
+    while pending:
+        # A worker that crashes breaks the whole pool, so a new pool is
+        # started for each round of retries
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.num_workers, mp_context=mp_context,
+                initializer=init_worker, initargs=(args,)) as executor:
+            futures = {
+                executor.submit(parse_shard, shard, os.path.join(shard_dir, shard['id'] + ".txt")): shard
+                for shard in pending
+            }
+            pending = []
+            for future in concurrent.futures.as_completed(futures):
+                shard = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    attempts[shard['id']] += 1
+                    print("Shard {} failed (attempt {}): {}: {}".format(
+                        shard['id'], attempts[shard['id']], type(e).__name__, e), flush=True)
+                    if attempts[shard['id']] <= args.max_retries:
+                        pending.append(shard)
+                    else:
+                        failed.append(shard)
+                    continue
+                manifest['completed'][shard['id']] = shard['lines']
+                save_manifest(manifest_path, manifest)
+                print("Shard {} done ({:,}/{:,} shards)".format(
+                    shard['id'], len(manifest['completed']), manifest['num_shards']), flush=True)
+    return failed
+
+def merge_shards(input_paths, shards, shard_dir, output_dir):
+    output_paths = []
+    for input_path in input_paths:
+        output_path = os.path.join(output_dir, os.path.basename(input_path) + ".parsed")
+        with open(output_path, 'wb') as output_file:
+            for shard in shards:
+                if shard['input_path'] == input_path:
+                    with open(os.path.join(shard_dir, shard['id'] + ".txt"), 'rb') as shard_file:
+                        shutil.copyfileobj(shard_file, output_file)
+        output_paths.append(output_path)
+    return output_paths
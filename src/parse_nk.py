@@ -1,10 +1,13 @@
+import contextlib
 import functools
+import os.path
 
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.init as init
+import torch.utils.checkpoint
 
 use_cuda = torch.cuda.is_available()
 if use_cuda:
@@ -16,11 +19,18 @@ else:
     torch_t = torch
     from torch import from_numpy
 
-import pyximport
-pyximport.install(setup_args={"include_dirs": np.get_include()})
-import chart_helper
+try:
+    # Built ahead of time with: python setup.py build_ext --inplace
+    import chart_helper
+except ImportError:
+    # Fall back to compiling on first use, which needs a compiler at runtime
+    import pyximport
+    pyximport.install(setup_args={"include_dirs": np.get_include()})
+    import chart_helper
 import nkutil
 
+import batching
+import chart_store
 import trees
 
 START = "<START>"
@@ -29,6 +39,25 @@ UNK = "<UNK>"
 
 TAG_UNK = "UNK"
 
+# The per-word wordpiece cache is cleared when it grows past this many words
+BERT_WORD_IDS_CACHE_SIZE = 2**20
+
+# The per-word character id cache is cleared when it grows past this many words
+CHAR_IDS_CACHE_SIZE = 2**20
+
+# ELMo character ids, see
+# https://github.com/allenai/allennlp/blob/c3c3549887a6b1fb0bc8abf77bc820a3ab97f788/allennlp/data/token_indexers/elmo_indexer.py#L61
+# ELMO_START_SENTENCE = 256
+# ELMO_STOP_SENTENCE = 257
+ELMO_START_WORD = 258
+ELMO_STOP_WORD = 259
+ELMO_CHAR_PAD = 260
+ELMO_MAX_WORD_LEN = 50
+ELMO_OPTIONS_FILE = "data/elmo_2x4096_512_2048cnn_2xhighway_options.json"
+ELMO_WEIGHT_FILE = "data/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5"
+# The description of feature stores written by main.py precompute-elmo
+ELMO_FEATURES_DESCRIPTION = "ELMo biLM activations of {}".format(ELMO_WEIGHT_FILE)
+
 # Assumes that these control characters are not present in treebank text
 CHAR_UNK = "\0"
 CHAR_START_SENTENCE = "\1"
@@ -61,6 +90,20 @@ BERT_TOKEN_MAPPING = {
 
 # %%
 
+def precision_context(precision):
+    """
+    Context manager for running inference at the given precision ("fp32" or
+    "bf16"). In bf16 mode the embeddings, encoder stack and span scorer run
+    under autocast; label charts are converted back to float32 for decoding.
+    """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    assert precision == "bf16", "Unknown precision: {}".format(precision)
+    assert hasattr(torch, "autocast"), "bf16 inference requires PyTorch 1.10 or newer"
+    return torch.autocast("cuda" if use_cuda else "cpu", dtype=torch.bfloat16)
+
+# %%
+
 class BatchIndices:
     """
     Batch indices container class (used to implement packed batches)
@@ -70,6 +113,14 @@ class BatchIndices:
         # Note that the torch copy will be on GPU if use_cuda is set
         self.batch_idxs_torch = from_numpy(batch_idxs_np)
 
+        if batch_idxs_np[-1] == 0:
+            # A single sentence (e.g. from parse): nothing to search for
+            self.batch_size = 1
+            self.boundaries_np = np.array([0, len(batch_idxs_np)])
+            self.seq_lens_np = self.boundaries_np[1:]
+            self.max_len = len(batch_idxs_np)
+            return
+
         self.batch_size = int(1 + np.max(batch_idxs_np))
 
         batch_idxs_np_extra = np.concatenate([[-1], batch_idxs_np, [-1]])
@@ -78,6 +129,27 @@ class BatchIndices:
         assert len(self.seq_lens_np) == self.batch_size
         self.max_len = int(np.max(self.boundaries_np[1:] - self.boundaries_np[:-1]))
 
+def assign_state_dict(module, state_dict):
+    """
+    Like load_state_dict, but makes the module's parameters and buffers refer
+    to the given tensors instead of copying into them. This keeps weights
+    that are backed by a shared memory map shared.
+    """
+    own_state = dict(module.named_parameters())
+    own_state.update(module.named_buffers())
+    for name, tensor in state_dict.items():
+        if name not in own_state:
+            raise KeyError("Unexpected key in state_dict: {}".format(name))
+        if own_state[name].shape != tensor.shape:
+            raise RuntimeError("Size mismatch for {}: expected {}, got {}".format(
+                name, tuple(own_state[name].shape), tuple(tensor.shape)))
+        module_path, _, attr = name.rpartition('.')
+        submodule = functools.reduce(getattr, module_path.split('.'), module) if module_path else module
+        if attr in submodule._parameters:
+            submodule._parameters[attr].data = tensor
+        else:
+            submodule._buffers[attr] = tensor
+
 # %%
 
 class FeatureDropoutFunction(torch.autograd.function.InplaceFunction):
@@ -130,6 +202,9 @@ class FeatureDropout(nn.Module):
         self.inplace = inplace
 
     def forward(self, input, batch_idxs):
+        if not self.training:
+            # Nothing is dropped, so skip the copy made by the autograd function
+            return input
         return FeatureDropoutFunction.apply(input, batch_idxs, self.p, self.training, self.inplace)
 
 # %%
@@ -343,14 +418,20 @@ class MultiHeadAttention(nn.Module):
         # query/key/value for each head
         q_s, k_s, v_s = self.split_qkv_packed(inp, qk_inp=qk_inp)
 
-        # Switch to padded representation, perform attention, then switch back
-        q_padded, k_padded, v_padded, attn_mask, output_mask = self.pad_and_rearrange(q_s, k_s, v_s, batch_idxs)
+        if batch_idxs.batch_size == 1:
+            # A single sentence is already in padded form (n_head x len_inp x d)
+            # with nothing to mask
+            outputs_padded, attns_padded = self.attention(q_s, k_s, v_s)
+            outputs = outputs_padded.view(-1, self.d_v)
+        else:
+            # Switch to padded representation, perform attention, then switch back
+            q_padded, k_padded, v_padded, attn_mask, output_mask = self.pad_and_rearrange(q_s, k_s, v_s, batch_idxs)
 
-        outputs_padded, attns_padded = self.attention(
-            q_padded, k_padded, v_padded,
-            attn_mask=attn_mask,
-            )
-        outputs = outputs_padded[output_mask]
+            outputs_padded, attns_padded = self.attention(
+                q_padded, k_padded, v_padded,
+                attn_mask=attn_mask,
+                )
+            outputs = outputs_padded[output_mask]
         outputs = self.combine_v(outputs)
 
         outputs = self.residual_dropout(outputs, batch_idxs)
@@ -496,7 +577,10 @@ class MultiLevelEmbedding(nn.Module):
             else:
                 content_annotations += extra_content_annotations
 
-        timing_signal = torch.cat([self.position_table[:seq_len,:] for seq_len in batch_idxs.seq_lens_np], dim=0)
+        if batch_idxs.batch_size == 1:
+            timing_signal = self.position_table[:batch_idxs.max_len,:]
+        else:
+            timing_signal = torch.cat([self.position_table[:seq_len,:] for seq_len in batch_idxs.seq_lens_np], dim=0)
         timing_signal = self.timing_dropout(timing_signal, batch_idxs)
 
         # Combine the content and timing signals
@@ -563,10 +647,51 @@ def get_elmo_class():
     from allennlp.modules.elmo import Elmo
     return Elmo
 
+def get_elmo_bilm():
+    """
+    The frozen ELMo biLM alone, without the scalar mix, which returns the
+    activations of all its layers
+    """
+    from allennlp.modules.elmo import _ElmoBiLm
+    return _ElmoBiLm(ELMO_OPTIONS_FILE, ELMO_WEIGHT_FILE, requires_grad=False)
+
+def elmo_char_ids(word):
+    """
+    The array of utf-8 bytes of a word that the ELMo character encoder reads
+    """
+    assert word not in (START, STOP)
+    word_bytes = list(word.encode('utf-8', 'ignore')[:(ELMO_MAX_WORD_LEN-2)])
+    char_ids = np.full(ELMO_MAX_WORD_LEN, ELMO_CHAR_PAD, dtype=int)
+    char_ids[:len(word_bytes) + 2] = [ELMO_START_WORD] + word_bytes + [ELMO_STOP_WORD]
+    # +1 for masking
+    char_ids += 1
+    return char_ids
+
+def elmo_batch_char_ids(sentences, word_char_ids=elmo_char_ids):
+    """
+    The (batch, max length, ELMO_MAX_WORD_LEN) ELMo input for sentences.
+    Sentence start/stop tokens are added inside the ELMo module. Everything
+    that stays 0 is past the end of the sentence.
+    """
+    max_sentence_len = max([(len(sentence)) for sentence in sentences])
+    char_idxs = np.zeros((len(sentences), max_sentence_len, ELMO_MAX_WORD_LEN), dtype=int)
+    sentence_nums = np.repeat(np.arange(len(sentences)), [len(sentence) for sentence in sentences])
+    word_nums = np.concatenate([np.arange(len(sentence)) for sentence in sentences])
+    char_idxs[sentence_nums, word_nums] = np.stack(
+        [word_char_ids(word) for sentence in sentences for _, word in sentence])
+    return char_idxs
+
 # %%
-def get_bert(bert_model, bert_do_lower_case):
+def get_bert(bert_model, bert_do_lower_case, bert_files=None):
     # Avoid a hard dependency on BERT by only importing it if it's being used
-    from pytorch_pretrained_bert import BertTokenizer, BertModel
+    from pytorch_pretrained_bert import BertConfig, BertTokenizer, BertModel
+    if bert_files is not None:
+        # Only build the architecture: the caller is about to load a state_dict
+        # that overwrites all of the pretrained weights anyway
+        bert_config_path, bert_vocab_path = bert_files
+        tokenizer = BertTokenizer(bert_vocab_path, do_lower_case=bert_do_lower_case)
+        bert = BertModel(BertConfig.from_json_file(bert_config_path))
+        return tokenizer, bert
     if bert_model.endswith('.tar.gz'):
         tokenizer = BertTokenizer.from_pretrained(bert_model.replace('.tar.gz', '-vocab.txt'), do_lower_case=bert_do_lower_case)
     else:
@@ -574,6 +699,13 @@ def get_bert(bert_model, bert_do_lower_case):
     bert = BertModel.from_pretrained(bert_model)
     return tokenizer, bert
 
+def get_bert_files(model_path):
+    """
+    Paths of the BERT config and vocabulary files stored next to a checkpoint
+    """
+    base = os.path.splitext(model_path)[0]
+    return base + "-bert_config.json", base + "-vocab.txt"
+
 # %%
 
 class Encoder(nn.Module):
@@ -581,7 +713,8 @@ class Encoder(nn.Module):
                     num_layers=1, num_heads=2, d_kv = 32, d_ff=1024,
                     d_positional=None,
                     num_layers_position_only=0,
-                    relu_dropout=0.1, residual_dropout=0.1, attention_dropout=0.1):
+                    relu_dropout=0.1, residual_dropout=0.1, attention_dropout=0.1,
+                    checkpoint_activations=False):
         super().__init__()
         # Don't assume ownership of the embedding as a submodule.
         # TODO(nikita): what's the right thing to do here?
@@ -606,21 +739,83 @@ class Encoder(nn.Module):
         if self.num_layers_position_only > 0:
             assert d_positional is None, "num_layers_position_only and partitioned are incompatible"
 
+        # Only keep the input of each layer for the backward pass, and
+        # recompute the rest of its activations then
+        self.checkpoint_activations = checkpoint_activations
+
+    def layer_forward(self, i, res, batch_idxs, timing_signal):
+        attn, ff = self.stacks[i]
+        if i >= self.num_layers_position_only:
+            res, current_attns = attn(res, batch_idxs)
+        else:
+            res, current_attns = attn(res, batch_idxs, qk_inp=timing_signal)
+        return ff(res, batch_idxs)
+
     def forward(self, xs, batch_idxs, extra_content_annotations=None):
         emb = self.embedding_container[0]
         res, timing_signal, batch_idxs = emb(xs, batch_idxs, extra_content_annotations=extra_content_annotations)
 
-        for i, (attn, ff) in enumerate(self.stacks):
-            if i >= self.num_layers_position_only:
-                res, current_attns = attn(res, batch_idxs)
+        checkpoint = self.checkpoint_activations and torch.is_grad_enabled()
+        for i in range(len(self.stacks)):
+            if checkpoint:
+                # Non-reentrant checkpointing passes the non-tensor arguments
+                # (i, batch_idxs) through to the recomputation as they are,
+                # and computes parameter gradients even when no input
+                # requires grad
+                res = torch.utils.checkpoint.checkpoint(self.layer_forward, i, res, batch_idxs, timing_signal,
+                    use_reentrant=False)
             else:
-                res, current_attns = attn(res, batch_idxs, qk_inp=timing_signal)
-            res = ff(res, batch_idxs)
+                res = self.layer_forward(i, res, batch_idxs, timing_signal)
 
         return res, batch_idxs
 
 # %%
 
+def decode_chart(sentence, chart_np, label_vocab, gold=None):
+    """
+    Decodes a label score chart into the highest-scoring tree over sentence.
+    Only needs the label vocabulary, so charts can be decoded without a model.
+    """
+    decoder_args = dict(
+        sentence_len=len(sentence),
+        label_scores_chart=chart_np,
+        gold=gold,
+        label_vocab=label_vocab,
+        is_train=False)
+
+    force_gold = (gold is not None)
+
+    # The optimized cython decoder implementation doesn't actually
+    # generate trees, only scores and span indices. When converting to a
+    # tree, we assume that the indices follow a preorder traversal.
+    score, p_i, p_j, p_label, _ = chart_helper.decode(force_gold, **decoder_args)
+    last_splits = []
+    idx = -1
+    def make_tree():
+        nonlocal idx
+        idx += 1
+        i, j, label_idx = p_i[idx], p_j[idx], p_label[idx]
+        label = label_vocab.value(label_idx)
+        if (i + 1) >= j:
+            tag, word = sentence[i]
+            tree = trees.LeafParseNode(int(i), tag, word)
+            if label:
+                tree = trees.InternalParseNode(label, [tree])
+            return [tree]
+        else:
+            left_trees = make_tree()
+            right_trees = make_tree()
+            children = left_trees + right_trees
+            if label:
+                return [trees.InternalParseNode(label, children)]
+            else:
+                return children
+
+    tree = make_tree()[0]
+    return tree, score
+
+# %%
+
 class NKChartParser(nn.Module):
     # We never actually call forward() end-to-end as is typical for pytorch
     # modules, but this inheritance brings in good stuff like state dict
@@ -632,11 +827,13 @@ class NKChartParser(nn.Module):
             label_vocab,
             char_vocab,
             hparams,
+            bert_files=None,
     ):
         super().__init__()
         self.spec = locals()
         self.spec.pop("self")
         self.spec.pop("__class__")
+        self.spec.pop("bert_files")
         self.spec['hparams'] = hparams.to_dict()
 
         self.tag_vocab = tag_vocab
@@ -676,6 +873,11 @@ class NKChartParser(nn.Module):
         self.char_encoder = None
         self.elmo = None
         self.bert = None
+        # Character ids of each word, for the char LSTM or ELMo
+        self.char_ids_cache = {}
+        # A feature_store.FeatureStore of ELMo biLM activations, set by the
+        # caller to skip running the biLM on the sentences it contains
+        self.elmo_features = None
         if hparams.use_chars_lstm:
             assert not hparams.use_elmo, "use_chars_lstm and use_elmo are mutually exclusive"
             assert not hparams.use_bert, "use_chars_lstm and use_bert are mutually exclusive"
@@ -690,8 +892,8 @@ class NKChartParser(nn.Module):
             assert not hparams.use_bert, "use_elmo and use_bert are mutually exclusive"
             assert not hparams.use_bert_only, "use_elmo and use_bert_only are mutually exclusive"
             self.elmo = get_elmo_class()(
-                options_file="data/elmo_2x4096_512_2048cnn_2xhighway_options.json",
-                weight_file="data/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5",
+                options_file=ELMO_OPTIONS_FILE,
+                weight_file=ELMO_WEIGHT_FILE,
                 num_output_representations=1,
                 requires_grad=False,
                 do_layer_norm=False,
@@ -708,7 +910,7 @@ class NKChartParser(nn.Module):
             # the projection trainable appears to improve parsing accuracy
             self.project_elmo = nn.Linear(d_elmo_annotations, self.d_content, bias=False)
         elif hparams.use_bert or hparams.use_bert_only:
-            self.bert_tokenizer, self.bert = get_bert(hparams.bert_model, hparams.bert_do_lower_case)
+            self.bert_tokenizer, self.bert = get_bert(hparams.bert_model, hparams.bert_do_lower_case, bert_files)
             if hparams.bert_transliterate:
                 from transliterate import TRANSLITERATIONS
                 self.bert_transliterate = TRANSLITERATIONS[hparams.bert_transliterate]
@@ -718,6 +920,24 @@ class NKChartParser(nn.Module):
             d_bert_annotations = self.bert.pooler.dense.in_features
             self.bert_max_len = self.bert.embeddings.position_embeddings.num_embeddings
 
+            # Wordpiece ids of cleaned words, and encodings of whole sentences
+            # that were precomputed for a dataset (see wordpiece_cache.py)
+            self.bert_word_ids_cache = {}
+            self.bert_sentence_cache = {}
+
+            # The embeddings and the bottom bert_freeze_layers layers are not
+            # trained, and their output can be precomputed (see bert_features)
+            self.bert_freeze_layers = hparams.bert_freeze_layers
+            assert self.bert_freeze_layers <= len(self.bert.encoder.layer)
+            if self.bert_freeze_layers > 0:
+                for module in self.bert_frozen_modules():
+                    for param in module.parameters():
+                        param.requires_grad = False
+            # A feature_store.FeatureStore of the frozen layers' output, set by
+            # the caller to skip running them on the sentences it contains
+            self.bert_frozen_features = None
+            self.bert_checkpoint_activations = hparams.checkpoint_activations
+
             if hparams.use_bert_only:
                 self.project_bert = nn.Linear(d_bert_annotations, hparams.d_model, bias=False)
             else:
@@ -746,6 +966,7 @@ class NKChartParser(nn.Module):
                 relu_dropout=hparams.relu_dropout,
                 residual_dropout=hparams.residual_dropout,
                 attention_dropout=hparams.attention_dropout,
+                checkpoint_activations=hparams.checkpoint_activations,
             )
         else:
             self.embedding = None
@@ -777,8 +998,30 @@ class NKChartParser(nn.Module):
     def model(self):
         return self.state_dict()
 
+    @property
+    def dummy_tag(self):
+        # Tags are not available when parsing from raw text, so use a dummy tag
+        if 'UNK' in self.tag_vocab.indices:
+            return 'UNK'
+        else:
+            return self.tag_vocab.value(0)
+
+    def save_bert_files(self, model_path):
+        assert self.bert is not None
+        bert_config_path, bert_vocab_path = get_bert_files(model_path)
+        # Write to temporary files first, since several processes loading the
+        # same checkpoint may try to save these files at the same time
+        tmp_suffix = ".tmp{}".format(os.getpid())
+        with open(bert_config_path + tmp_suffix, 'w') as f:
+            f.write(self.bert.config.to_json_string())
+        with open(bert_vocab_path + tmp_suffix, 'w', encoding='utf-8') as f:
+            for token, _ in sorted(self.bert_tokenizer.vocab.items(), key=lambda item: item[1]):
+                f.write(token + "\n")
+        os.replace(bert_config_path + tmp_suffix, bert_config_path)
+        os.replace(bert_vocab_path + tmp_suffix, bert_vocab_path)
+
     @classmethod
-    def from_spec(cls, spec, model):
+    def from_spec(cls, spec, model, bert_files=None, assign=False):
         spec = spec.copy()
         hparams = spec['hparams']
         if 'use_chars_concat' in hparams and hparams['use_chars_concat']:
@@ -797,12 +1040,23 @@ class NKChartParser(nn.Module):
             hparams['predict_tags'] = False
         if 'bert_transliterate' not in hparams:
             hparams['bert_transliterate'] = ""
+        if 'bert_freeze_layers' not in hparams:
+            hparams['bert_freeze_layers'] = 0
+        if 'checkpoint_activations' not in hparams:
+            hparams['checkpoint_activations'] = False
 
         spec['hparams'] = nkutil.HParams(**hparams)
-        res = cls(**spec)
+        # When BERT config/vocab files are available, the pretrained weights
+        # are not loaded since the state_dict below replaces them
+        res = cls(**spec, bert_files=bert_files)
         if use_cuda:
             res.cpu()
-        if not hparams['use_elmo']:
+        if assign:
+            # Weights that are not in the state_dict (ELMo) keep their values
+            missing = set(res.state_dict()) - set(model)
+            assert not missing or hparams['use_elmo'], "Missing keys in state_dict: {}".format(sorted(missing))
+            assign_state_dict(res, model)
+        elif not hparams['use_elmo']:
             res.load_state_dict(model)
         else:
             state = {k: v for k,v in res.state_dict().items() if k not in model}
@@ -812,41 +1066,215 @@ class NKChartParser(nn.Module):
             res.cuda()
         return res
 
-    def split_batch(self, sentences, golds, subbatch_max_tokens=3000):
+    def bert_words(self, sentence):
+        if self.bert_transliterate is not None:
+            # When transliterating, assume that the token mapping is
+            # taken care of elsewhere
+            return [self.bert_transliterate(word) for _, word in sentence]
+
+        cleaned_words = []
+        for _, word in sentence:
+            word = BERT_TOKEN_MAPPING.get(word, word)
+            # This un-escaping for / and * was not yet added for the
+            # parser version in https://arxiv.org/abs/1812.11760v1
+            # and related model releases (e.g. benepar_en2)
+            word = word.replace('\\/', '/').replace('\\*', '*')
+            # Mid-token punctuation occurs in biomedical text
+            word = word.replace('-LSB-', '[').replace('-RSB-', ']')
+            word = word.replace('-LRB-', '(').replace('-RRB-', ')')
+            if word == "n't" and cleaned_words:
+                cleaned_words[-1] = cleaned_words[-1] + "n"
+                word = "'t"
+            cleaned_words.append(word)
+        return cleaned_words
+
+    def bert_frozen_modules(self):
+        return [self.bert.embeddings] + list(self.bert.encoder.layer[:self.bert_freeze_layers])
+
+    def bert_frozen_states(self, all_input_ids, all_input_mask):
+        """
+        The output of the frozen bottom BERT layers. These always run without
+        dropout, so that their output does not depend on whether it was
+        precomputed.
+        """
+        extended_attention_mask = (1.0 - all_input_mask[:, None, None, :].float()) * -10000.0
+        frozen_modules = self.bert_frozen_modules()
+        modes = [module.training for module in frozen_modules]
+        for module in frozen_modules:
+            module.eval()
+        try:
+            with torch.no_grad():
+                hidden_states = self.bert.embeddings(all_input_ids, torch.zeros_like(all_input_ids))
+                for layer in self.bert.encoder.layer[:self.bert_freeze_layers]:
+                    hidden_states = layer(hidden_states, extended_attention_mask)
+        finally:
+            for module, mode in zip(frozen_modules, modes):
+                module.train(mode)
+        return hidden_states
+
+    def bert_features(self, all_input_ids, all_input_mask, frozen_states=None):
+        """
+        The last BERT layer. With bert_freeze_layers, only the layers above
+        the frozen ones run with gradients, starting from frozen_states
+        (precomputed output of the frozen layers) when it is given. With
+        checkpoint_activations, the trained layers are checkpointed.
+        """
+        checkpoint = self.bert_checkpoint_activations and torch.is_grad_enabled()
+        if self.bert_freeze_layers == 0 and not checkpoint:
+            all_encoder_layers, _ = self.bert(all_input_ids, attention_mask=all_input_mask)
+            return all_encoder_layers[-1]
+
+        if frozen_states is not None:
+            hidden_states = from_numpy(frozen_states)
+        elif self.bert_freeze_layers > 0:
+            hidden_states = self.bert_frozen_states(all_input_ids, all_input_mask)
+        else:
+            hidden_states = self.bert.embeddings(all_input_ids, torch.zeros_like(all_input_ids))
+        # As in BertModel.forward
+        extended_attention_mask = (1.0 - all_input_mask[:, None, None, :].to(dtype=hidden_states.dtype)) * -10000.0
+        for layer in self.bert.encoder.layer[self.bert_freeze_layers:]:
+            if checkpoint:
+                # Non-reentrant, as in Encoder.forward: frozen_states and the
+                # output of the frozen layers do not require grad
+                hidden_states = torch.utils.checkpoint.checkpoint(layer, hidden_states, extended_attention_mask,
+                    use_reentrant=False)
+            else:
+                hidden_states = layer(hidden_states, extended_attention_mask)
+        return hidden_states
+
+    def bert_word_ids(self, word):
+        """
+        The wordpiece ids of a cleaned word (see bert_words), cached per word
+        """
+        ids = self.bert_word_ids_cache.get(word)
+        if ids is None:
+            ids = self.bert_tokenizer.convert_tokens_to_ids(self.bert_tokenizer.tokenize(word))
+            if len(self.bert_word_ids_cache) >= BERT_WORD_IDS_CACHE_SIZE:
+                self.bert_word_ids_cache.clear()
+            self.bert_word_ids_cache[word] = ids
+        return ids
+
+    def bert_encode(self, sentence):
+        """
+        Returns the wordpiece ids of a sentence, including [CLS] and [SEP],
+        and masks of the first and of the last wordpiece of each word
+        """
+        encoded = self.bert_sentence_cache.get(tuple(word for _, word in sentence))
+        if encoded is not None:
+            return encoded
+
+        word_ids = [self.bert_word_ids(word) for word in self.bert_words(sentence)]
+        word_lens = np.asarray([1] + [len(ids) for ids in word_ids] + [1])
+        input_ids = np.asarray(
+            self.bert_tokenizer.convert_tokens_to_ids(["[CLS]"])
+            + [i for ids in word_ids for i in ids]
+            + self.bert_tokenizer.convert_tokens_to_ids(["[SEP]"]), dtype=int)
+        word_ends = np.cumsum(word_lens) - 1
+        word_start_mask = np.zeros(len(input_ids), dtype=int)
+        word_start_mask[word_ends - word_lens + 1] = 1
+        word_end_mask = np.zeros(len(input_ids), dtype=int)
+        word_end_mask[word_ends] = 1
+        return input_ids, word_start_mask, word_end_mask
+
+    def word_char_ids(self, word):
+        """
+        The character ids of a word, cached per word: for the char LSTM, the
+        char vocabulary indices with start/stop of word markers, and for ELMo
+        the padded array of utf-8 bytes that the ELMo character encoder reads
+        """
+        char_ids = self.char_ids_cache.get(word)
+        if char_ids is not None:
+            return char_ids
+
+        if self.char_encoder is not None:
+            if word in (START, STOP):
+                chars = [CHAR_START_SENTENCE if (word == START) else CHAR_STOP_SENTENCE] * 3
+            else:
+                chars = word
+            char_ids = np.asarray(
+                [self.char_vocab.index(CHAR_START_WORD)]
+                + [self.char_vocab.index_or_unk(char, CHAR_UNK) for char in chars]
+                + [self.char_vocab.index(CHAR_STOP_WORD)], dtype=int)
+        else:
+            char_ids = elmo_char_ids(word)
+
+        if len(self.char_ids_cache) >= CHAR_IDS_CACHE_SIZE:
+            self.char_ids_cache.clear()
+        self.char_ids_cache[word] = char_ids
+        return char_ids
+
+    def sentence_lengths(self, sentences):
+        """
+        Lengths of the sentences as seen by the encoder, including the start
+        and end tokens: subword lengths for BERT models, word lengths otherwise
+        """
         if self.bert is not None:
-            lens = [
-                len(self.bert_tokenizer.tokenize(' '.join([word for (_, word) in sentence]))) + 2
-                for sentence in sentences
-            ]
+            return [len(self.bert_encode(sentence)[0]) for sentence in sentences]
         else:
-            lens = [len(sentence) + 2 for sentence in sentences]
-
-        lens = np.asarray(lens, dtype=int)
-        lens_argsort = np.argsort(lens).tolist()
-
-        num_subbatches = 0
-        subbatch_size = 1
-        while lens_argsort:
-            if (subbatch_size == len(lens_argsort)) or (subbatch_size * lens[lens_argsort[subbatch_size]] > subbatch_max_tokens):
-                yield [sentences[i] for i in lens_argsort[:subbatch_size]], [golds[i] for i in lens_argsort[:subbatch_size]]
-                lens_argsort = lens_argsort[subbatch_size:]
-                num_subbatches += 1
-                subbatch_size = 1
+            return [len(sentence) + 2 for sentence in sentences]
+
+    def estimate_batch_bytes(self, batch_size, max_len, is_train=False):
+        """
+        Rough estimate of the peak activation memory, in bytes, of parsing
+        batch_size sentences padded to max_len tokens. It counts the
+        attention maps of each layer, which grow with max_len ** 2, and the
+        per-token activations of each layer. During training these are kept
+        for every layer for the backward pass, while at inference only one
+        layer is live at a time. With checkpoint_activations, training keeps
+        only the input of each layer plus the activations of the one layer
+        being recomputed. The span chart is built one sentence at a time, so
+        only the chart of a single sentence of max_len is added.
+        """
+        hparams = self.spec['hparams']
+        stacks = []
+        if self.bert is not None:
+            config = self.bert.config
+            stacks.append((config.num_hidden_layers, config.num_attention_heads,
+                config.hidden_size, config.intermediate_size))
+        if self.encoder is not None:
+            stacks.append((hparams['num_layers'], hparams['num_heads'], hparams['d_model'], hparams['d_ff']))
+
+        num_floats = 0
+        for num_layers, num_heads, d_hidden, d_ff in stacks:
+            # Query, key, value, attention output, residual and feed-forward
+            # activations, plus attention scores and probabilities
+            per_layer = batch_size * max_len * (5 * d_hidden + d_ff) + 2 * batch_size * num_heads * max_len * max_len
+            if not is_train:
+                num_floats += per_layer
+            elif hparams['checkpoint_activations']:
+                num_floats += per_layer + num_layers * batch_size * max_len * d_hidden
             else:
-                subbatch_size += 1
+                num_floats += per_layer * num_layers
+        num_floats += max_len * max_len * (hparams['d_model'] + 2 * hparams['d_label_hidden'] + self.label_vocab.size)
+        return 4 * num_floats
+
+    def split_batch(self, sentences, golds, subbatch_max_tokens=3000, subbatch_max_bytes=None):
+        subbatches = batching.make_batches(
+            self.sentence_lengths(sentences),
+            max_tokens=subbatch_max_tokens,
+            max_bytes=subbatch_max_bytes,
+            estimate_bytes=functools.partial(self.estimate_batch_bytes, is_train=True),
+        )
+        for subbatch in subbatches:
+            yield [sentences[i] for i in subbatch], [golds[i] for i in subbatch]
 
     def parse(self, sentence, gold=None):
+        """
+        Parses a single sentence. Batches of one sentence skip the packed-batch
+        machinery: BatchIndices does no boundary search, attention runs
+        without padding, masks or unpacking, and the position signal is a
+        slice of the position table.
+        """
         tree_list, loss_list = self.parse_batch([sentence], [gold] if gold is not None else None)
         return tree_list[0], loss_list[0]
 
-    def parse_batch(self, sentences, golds=None, return_label_scores_charts=False):
-        is_train = golds is not None
-        self.train(is_train)
-        torch.set_grad_enabled(is_train)
-
-        if golds is None:
-            golds = [None] * len(sentences)
-
+    def prepare_batch(self, sentences, is_train=False):
+        """
+        Builds the numpy inputs to the network for a batch of sentences: the
+        vocabulary lookups, character ids and wordpiece tokenization in
+        parse_batch. No torch operations are run here, so batches can be
+        prepared in another thread while the network runs.
+        """
         packed_len = sum([(len(sentence) + 2) for sentence in sentences])
 
         i = 0
@@ -865,11 +1293,97 @@ class NKChartParser(nn.Module):
                 i += 1
         assert i == packed_len
 
-        batch_idxs = BatchIndices(batch_idxs)
+        prepared = dict(
+            packed_len=packed_len,
+            tag_idxs=tag_idxs,
+            word_idxs=word_idxs,
+            batch_idxs=batch_idxs,
+        )
+
+        if self.char_encoder is not None:
+            words = [word for sentence in sentences for _, word in [(START, START)] + sentence + [(STOP, STOP)]]
+            word_char_ids = [self.word_char_ids(word) for word in words]
+            word_lens_encoder = np.asarray([len(char_ids) for char_ids in word_char_ids])
+            # Padded to the longest word in the batch (at least 5, the length of
+            # the start/stop tokens)
+            char_idxs_encoder = np.zeros((packed_len, word_lens_encoder.max()), dtype=int)
+            word_starts = np.cumsum(word_lens_encoder) - word_lens_encoder
+            rows = np.repeat(np.arange(packed_len), word_lens_encoder)
+            cols = np.arange(word_lens_encoder.sum()) - np.repeat(word_starts, word_lens_encoder)
+            char_idxs_encoder[rows, cols] = np.concatenate(word_char_ids)
+
+            prepared['char_idxs'] = char_idxs_encoder
+            prepared['word_lens'] = word_lens_encoder
+        elif self.elmo is not None:
+            # Precomputed biLM activations, if every sentence is in the store
+            elmo_layers = None
+            if self.elmo_features is not None:
+                elmo_layers = self.elmo_features.gather(sentences)
+            if elmo_layers is not None:
+                prepared['elmo_layers'] = elmo_layers
+            else:
+                prepared['elmo_char_idxs'] = elmo_batch_char_ids(sentences, self.word_char_ids)
+        elif self.bert is not None:
+            encoded = [self.bert_encode(sentence) for sentence in sentences]
+
+            # Arrays are only as wide as the longest sentence in the batch
+            subword_max_len = max(len(input_ids) for input_ids, _, _ in encoded)
+            assert subword_max_len <= self.bert_max_len, \
+                "Sentence of {} subwords is longer than BERT supports ({})".format(subword_max_len, self.bert_max_len)
+            all_input_ids = np.zeros((len(sentences), subword_max_len), dtype=int)
+            all_input_mask = np.zeros((len(sentences), subword_max_len), dtype=int)
+            all_word_start_mask = np.zeros((len(sentences), subword_max_len), dtype=int)
+            all_word_end_mask = np.zeros((len(sentences), subword_max_len), dtype=int)
+            for snum, (input_ids, word_start_mask, word_end_mask) in enumerate(encoded):
+                all_input_ids[snum, :len(input_ids)] = input_ids
+                # The mask has 1 for real tokens and 0 for padding tokens. Only real
+                # tokens are attended to.
+                all_input_mask[snum, :len(input_ids)] = 1
+                all_word_start_mask[snum, :len(input_ids)] = word_start_mask
+                all_word_end_mask[snum, :len(input_ids)] = word_end_mask
+
+            prepared['bert_input_ids'] = all_input_ids
+            prepared['bert_input_mask'] = all_input_mask
+            prepared['bert_word_start_mask'] = all_word_start_mask
+            prepared['bert_word_end_mask'] = all_word_end_mask
+
+            if self.bert_frozen_features is not None:
+                frozen_states = [self.bert_frozen_features.find(sentence) for sentence in sentences]
+                if None not in frozen_states:
+                    all_frozen_states = np.zeros((len(sentences), subword_max_len) + self.bert_frozen_features.row_shape, dtype=np.float32)
+                    for snum, index in enumerate(frozen_states):
+                        rows = self.bert_frozen_features.rows(index)
+                        all_frozen_states[snum, :len(rows)] = rows
+                    prepared['bert_frozen_states'] = all_frozen_states
+
+        return prepared
+
+    def parse_batch(self, sentences, golds=None, return_label_scores_charts=False, prepared=None, teacher_charts=None, tagged=None):
+        """
+        With teacher_charts (the packed charts of a chart_store.ChartStore),
+        trains on the squared error between the label scores of every span
+        and the teacher's, averaged over labels and summed over spans. golds
+        may then contain None for sentences without a gold tree, and the
+        losses are returned as (chart_loss, gold_loss, tag_loss). tagged can
+        mark the sentences whose tags are real, so that the tag loss skips
+        the others (e.g. raw sentences with dummy tags).
+        """
+        is_train = golds is not None or teacher_charts is not None
+        self.train(is_train)
+        torch.set_grad_enabled(is_train)
+
+        if golds is None:
+            golds = [None] * len(sentences)
+
+        if prepared is None:
+            prepared = self.prepare_batch(sentences, is_train)
+        packed_len = prepared['packed_len']
+
+        batch_idxs = BatchIndices(prepared['batch_idxs'])
 
         emb_idxs_map = {
-            'tags': tag_idxs,
-            'words': word_idxs,
+            'tags': prepared['tag_idxs'],
+            'words': prepared['word_idxs'],
         }
         emb_idxs = [
             from_numpy(emb_idxs_map[emb_type])
@@ -877,68 +1391,27 @@ class NKChartParser(nn.Module):
             ]
 
         if is_train and self.f_tag is not None:
-            gold_tag_idxs = from_numpy(emb_idxs_map['tags'])
+            gold_tag_idxs = emb_idxs_map['tags']
+            if tagged is not None:
+                gold_tag_idxs = np.where(np.asarray(tagged, dtype=bool)[prepared['batch_idxs']], gold_tag_idxs, -100)
+            gold_tag_idxs = from_numpy(gold_tag_idxs)
 
         extra_content_annotations = None
         if self.char_encoder is not None:
             assert isinstance(self.char_encoder, CharacterLSTM)
-            max_word_len = max([max([len(word) for tag, word in sentence]) for sentence in sentences])
-            # Add 2 for start/stop tokens
-            max_word_len = max(max_word_len, 3) + 2
-            char_idxs_encoder = np.zeros((packed_len, max_word_len), dtype=int)
-            word_lens_encoder = np.zeros(packed_len, dtype=int)
-
-            i = 0
-            for snum, sentence in enumerate(sentences):
-                for wordnum, (tag, word) in enumerate([(START, START)] + sentence + [(STOP, STOP)]):
-                    j = 0
-                    char_idxs_encoder[i, j] = self.char_vocab.index(CHAR_START_WORD)
-                    j += 1
-                    if word in (START, STOP):
-                        char_idxs_encoder[i, j:j+3] = self.char_vocab.index(
-                            CHAR_START_SENTENCE if (word == START) else CHAR_STOP_SENTENCE
-                            )
-                        j += 3
-                    else:
-                        for char in word:
-                            char_idxs_encoder[i, j] = self.char_vocab.index_or_unk(char, CHAR_UNK)
-                            j += 1
-                    char_idxs_encoder[i, j] = self.char_vocab.index(CHAR_STOP_WORD)
-                    word_lens_encoder[i] = j + 1
-                    i += 1
-            assert i == packed_len
-
-            extra_content_annotations = self.char_encoder(char_idxs_encoder, word_lens_encoder, batch_idxs)
+            extra_content_annotations = self.char_encoder(prepared['char_idxs'], prepared['word_lens'], batch_idxs)
+        elif self.elmo is not None and 'elmo_layers' in prepared:
+            # Same as Elmo.forward, on stored biLM activations. These are
+            # already packed, including the sentence boundary positions that
+            # the mask selects below.
+            elmo_layers = from_numpy(prepared['elmo_layers'])
+            elmo_rep0 = self.elmo.scalar_mix_0([elmo_layers[:, k] for k in range(elmo_layers.shape[1])])
+            elmo_annotations_packed = self.elmo._dropout(elmo_rep0)
+
+            # Apply projection to match dimensionality
+            extra_content_annotations = self.project_elmo(elmo_annotations_packed)
         elif self.elmo is not None:
-            # See https://github.com/allenai/allennlp/blob/c3c3549887a6b1fb0bc8abf77bc820a3ab97f788/allennlp/data/token_indexers/elmo_indexer.py#L61
-            # ELMO_START_SENTENCE = 256
-            # ELMO_STOP_SENTENCE = 257
-            ELMO_START_WORD = 258
-            ELMO_STOP_WORD = 259
-            ELMO_CHAR_PAD = 260
-
-            # Sentence start/stop tokens are added inside the ELMo module
-            max_sentence_len = max([(len(sentence)) for sentence in sentences])
-            max_word_len = 50
-            char_idxs_encoder = np.zeros((len(sentences), max_sentence_len, max_word_len), dtype=int)
-
-            for snum, sentence in enumerate(sentences):
-                for wordnum, (tag, word) in enumerate(sentence):
-                    char_idxs_encoder[snum, wordnum, :] = ELMO_CHAR_PAD
-
-                    j = 0
-                    char_idxs_encoder[snum, wordnum, j] = ELMO_START_WORD
-                    j += 1
-                    assert word not in (START, STOP)
-                    for char_id in word.encode('utf-8', 'ignore')[:(max_word_len-2)]:
-                        char_idxs_encoder[snum, wordnum, j] = char_id
-                        j += 1
-                    char_idxs_encoder[snum, wordnum, j] = ELMO_STOP_WORD
-
-                    # +1 for masking (everything that stays 0 is past the end of the sentence)
-                    char_idxs_encoder[snum, wordnum, :] += 1
-
-            char_idxs_encoder = from_numpy(char_idxs_encoder)
+            char_idxs_encoder = from_numpy(prepared['elmo_char_idxs'])
 
             elmo_out = self.elmo.forward(char_idxs_encoder)
             elmo_rep0 = elmo_out['elmo_representations'][0]
@@ -949,73 +1422,11 @@ class NKChartParser(nn.Module):
             # Apply projection to match dimensionality
             extra_content_annotations = self.project_elmo(elmo_annotations_packed)
         elif self.bert is not None:
-            all_input_ids = np.zeros((len(sentences), self.bert_max_len), dtype=int)
-            all_input_mask = np.zeros((len(sentences), self.bert_max_len), dtype=int)
-            all_word_start_mask = np.zeros((len(sentences), self.bert_max_len), dtype=int)
-            all_word_end_mask = np.zeros((len(sentences), self.bert_max_len), dtype=int)
-
-            subword_max_len = 0
-            for snum, sentence in enumerate(sentences):
-                tokens = []
-                word_start_mask = []
-                word_end_mask = []
-
-                tokens.append("[CLS]")
-                word_start_mask.append(1)
-                word_end_mask.append(1)
-
-                if self.bert_transliterate is None:
-                    cleaned_words = []
-                    for _, word in sentence:
-                        word = BERT_TOKEN_MAPPING.get(word, word)
-                        # This un-escaping for / and * was not yet added for the
-                        # parser version in https://arxiv.org/abs/1812.11760v1
-                        # and related model releases (e.g. benepar_en2)
-                        word = word.replace('\\/', '/').replace('\\*', '*')
-                        # Mid-token punctuation occurs in biomedical text
-                        word = word.replace('-LSB-', '[').replace('-RSB-', ']')
-                        word = word.replace('-LRB-', '(').replace('-RRB-', ')')
-                        if word == "n't" and cleaned_words:
-                            cleaned_words[-1] = cleaned_words[-1] + "n"
-                            word = "'t"
-                        cleaned_words.append(word)
-                else:
-                    # When transliterating, assume that the token mapping is
-                    # taken care of elsewhere
-                    cleaned_words = [self.bert_transliterate(word) for _, word in sentence]
-
-                for word in cleaned_words:
-                    word_tokens = self.bert_tokenizer.tokenize(word)
-                    for _ in range(len(word_tokens)):
-                        word_start_mask.append(0)
-                        word_end_mask.append(0)
-                    word_start_mask[len(tokens)] = 1
-                    word_end_mask[-1] = 1
-                    tokens.extend(word_tokens)
-                tokens.append("[SEP]")
-                word_start_mask.append(1)
-                word_end_mask.append(1)
-
-                input_ids = self.bert_tokenizer.convert_tokens_to_ids(tokens)
-
-                # The mask has 1 for real tokens and 0 for padding tokens. Only real
-                # tokens are attended to.
-                input_mask = [1] * len(input_ids)
-
-                subword_max_len = max(subword_max_len, len(input_ids))
-
-                all_input_ids[snum, :len(input_ids)] = input_ids
-                all_input_mask[snum, :len(input_mask)] = input_mask
-                all_word_start_mask[snum, :len(word_start_mask)] = word_start_mask
-                all_word_end_mask[snum, :len(word_end_mask)] = word_end_mask
-
-            all_input_ids = from_numpy(np.ascontiguousarray(all_input_ids[:, :subword_max_len]))
-            all_input_mask = from_numpy(np.ascontiguousarray(all_input_mask[:, :subword_max_len]))
-            all_word_start_mask = from_numpy(np.ascontiguousarray(all_word_start_mask[:, :subword_max_len]))
-            all_word_end_mask = from_numpy(np.ascontiguousarray(all_word_end_mask[:, :subword_max_len]))
-            all_encoder_layers, _ = self.bert(all_input_ids, attention_mask=all_input_mask)
-            del _
-            features = all_encoder_layers[-1]
+            all_input_ids = from_numpy(prepared['bert_input_ids'])
+            all_input_mask = from_numpy(prepared['bert_input_mask'])
+            all_word_start_mask = from_numpy(prepared['bert_word_start_mask'])
+            all_word_end_mask = from_numpy(prepared['bert_word_end_mask'])
+            features = self.bert_features(all_input_ids, all_input_mask, prepared.get('bert_frozen_states'))
 
             if self.encoder is not None:
                 features_packed = features.masked_select(all_word_end_mask.to(torch.uint8).unsqueeze(-1)).reshape(-1, features.shape[-1])
@@ -1063,12 +1474,20 @@ class NKChartParser(nn.Module):
         fp_startpoints = batch_idxs.boundaries_np[:-1]
         fp_endpoints = batch_idxs.boundaries_np[1:] - 1
 
+        if teacher_charts is not None:
+            chart_loss = 0.0
+            for i, (start, end) in enumerate(zip(fp_startpoints, fp_endpoints)):
+                chart = self.label_scores_from_annotations(fencepost_annotations_start[start:end,:], fencepost_annotations_end[start:end,:])
+                span_i, span_j = chart_store.span_indices(len(sentences[i]))
+                span_scores = chart[from_numpy(span_i), from_numpy(span_j), 1:]
+                chart_loss = chart_loss + ((span_scores - from_numpy(teacher_charts[i])) ** 2).mean(1).sum()
+
         # Just return the charts, for ensembling
         if return_label_scores_charts:
             charts = []
             for i, (start, end) in enumerate(zip(fp_startpoints, fp_endpoints)):
                 chart = self.label_scores_from_annotations(fencepost_annotations_start[start:end,:], fencepost_annotations_end[start:end,:])
-                charts.append(chart.cpu().data.numpy())
+                charts.append(chart.float().cpu().data.numpy())
             return charts
 
         if not is_train:
@@ -1107,6 +1526,8 @@ class NKChartParser(nn.Module):
         glabels = []
         with torch.no_grad():
             for i, (start, end) in enumerate(zip(fp_startpoints, fp_endpoints)):
+                if golds[i] is None:
+                    continue
                 p_i, p_j, p_label, p_augment, g_i, g_j, g_label = self.parse_from_annotations(fencepost_annotations_start[start:end,:], fencepost_annotations_end[start:end,:], sentences[i], golds[i])
                 paugment_total += p_augment
                 num_p += p_i.shape[0]
@@ -1117,18 +1538,23 @@ class NKChartParser(nn.Module):
                 plabels.append(p_label)
                 glabels.append(g_label)
 
-        cells_i = from_numpy(np.concatenate(pis + gis))
-        cells_j = from_numpy(np.concatenate(pjs + gjs))
-        cells_label = from_numpy(np.concatenate(plabels + glabels))
-
-        cells_label_scores = self.f_label(fencepost_annotations_end[cells_j] - fencepost_annotations_start[cells_i])
-        cells_label_scores = torch.cat([
-                    cells_label_scores.new_zeros((cells_label_scores.size(0), 1)),
-                    cells_label_scores
-                    ], 1)
-        cells_scores = torch.gather(cells_label_scores, 1, cells_label[:, None])
-        loss = cells_scores[:num_p].sum() - cells_scores[num_p:].sum() + paugment_total
+        if pis:
+            cells_i = from_numpy(np.concatenate(pis + gis))
+            cells_j = from_numpy(np.concatenate(pjs + gjs))
+            cells_label = from_numpy(np.concatenate(plabels + glabels))
+
+            cells_label_scores = self.f_label(fencepost_annotations_end[cells_j] - fencepost_annotations_start[cells_i])
+            cells_label_scores = torch.cat([
+                        cells_label_scores.new_zeros((cells_label_scores.size(0), 1)),
+                        cells_label_scores
+                        ], 1)
+            cells_scores = torch.gather(cells_label_scores, 1, cells_label[:, None])
+            loss = cells_scores[:num_p].sum() - cells_scores[num_p:].sum() + paugment_total
+        else:
+            loss = 0.0
 
+        if teacher_charts is not None:
+            return None, (chart_loss, loss, tag_loss if self.f_tag is not None else None)
         if self.f_tag is not None:
             return None, (loss, tag_loss)
         else:
@@ -1150,7 +1576,7 @@ class NKChartParser(nn.Module):
     def parse_from_annotations(self, fencepost_annotations_start, fencepost_annotations_end, sentence, gold=None):
         is_train = gold is not None
         label_scores_chart = self.label_scores_from_annotations(fencepost_annotations_start, fencepost_annotations_end)
-        label_scores_chart_np = label_scores_chart.cpu().data.numpy()
+        label_scores_chart_np = label_scores_chart.float().cpu().data.numpy()
 
         if is_train:
             decoder_args = dict(
@@ -1178,40 +1604,4 @@ class NKChartParser(nn.Module):
         return trees, scores
 
     def decode_from_chart(self, sentence, chart_np, gold=None):
-        decoder_args = dict(
-            sentence_len=len(sentence),
-            label_scores_chart=chart_np,
-            gold=gold,
-            label_vocab=self.label_vocab,
-            is_train=False)
-
-        force_gold = (gold is not None)
-
-        # The optimized cython decoder implementation doesn't actually
-        # generate trees, only scores and span indices. When converting to a
-        # tree, we assume that the indices follow a preorder traversal.
-        score, p_i, p_j, p_label, _ = chart_helper.decode(force_gold, **decoder_args)
-        last_splits = []
-        idx = -1
-        def make_tree():
-            nonlocal idx
-            idx += 1
-            i, j, label_idx = p_i[idx], p_j[idx], p_label[idx]
-            label = self.label_vocab.value(label_idx)
-            if (i + 1) >= j:
-                tag, word = sentence[i]
-                tree = trees.LeafParseNode(int(i), tag, word)
-                if label:
-                    tree = trees.InternalParseNode(label, [tree])
-                return [tree]
-            else:
-                left_trees = make_tree()
-                right_trees = make_tree()
-                children = left_trees + right_trees
-                if label:
-                    return [trees.InternalParseNode(label, children)]
-                else:
-                    return children
-
-        tree = make_tree()[0]
-        return tree, score
+        return decode_chart(sentence, chart_np, self.label_vocab, gold)
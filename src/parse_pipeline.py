@@ -0,0 +1,189 @@
+"""
+Pipelined parsing of raw text. Each batch passes through three stages that
+run in their own threads, connected by bounded queues:
+    prepare: length-sorted batching, tokenization and index building
+             (NKChartParser.prepare_batch)
+    encode:  the network forward pass, producing label score charts
+    decode:  CKY decoding, tree building and writing the output
+so that while batch k is being encoded, batch k+1 is prepared and batch k-1
+is decoded and written. The prepare and decode stages are mostly Python,
+while the encoder spends most of its time in torch operations that release
+the GIL.
+
+Each stage's utilization (the fraction of the wall time that it spent
+working rather than waiting on its queues) shows which stage is the
+bottleneck.
+"""
+
+import queue
+import threading
+import time
+
+import batching
+
+class Stage:
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.busy_time = 0.0
+        self.num_items = 0
+
+def run_pipeline(source, stages, queue_size=2):
+    """
+    Feeds the items of the source iterator through the stage functions, each
+    running in its own thread, and returns the wall time taken. The source
+    is iterated in the thread of the first stage. An exception in any stage
+    stops the pipeline and is re-raised here.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+    stop = threading.Event()
+    errors = []
+    done = object()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done
+
+    def run_stage(stage_num):
+        stage = stages[stage_num]
+        in_queue = queues[stage_num - 1] if stage_num > 0 else None
+        out_queue = queues[stage_num] if stage_num < len(queues) else None
+        items = iter(source)
+        try:
+            while True:
+                start_time = time.perf_counter()
+                if in_queue is None:
+                    item = next(items, done)
+                    if item is not done:
+                        item = stage.fn(item)
+                else:
+                    # Time spent waiting for the previous stage is not counted
+                    item = get(in_queue)
+                    start_time = time.perf_counter()
+                    if item is not done:
+                        item = stage.fn(item)
+                stage.busy_time += time.perf_counter() - start_time
+                if item is done:
+                    break
+                stage.num_items += 1
+                if out_queue is not None and not put(out_queue, item):
+                    return
+            if out_queue is not None:
+                put(out_queue, done)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=run_stage, args=(stage_num,), daemon=True)
+               for stage_num in range(len(stages))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+    except KeyboardInterrupt:
+        stop.set()
+        raise
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - start_time
+
+def parse_pipelined(parser, windows, write_window, precision="fp32", queue_size=2, cache=None, **batch_limits):
+    """
+    Parses raw sentences with a three-stage pipeline. windows yields
+    (sentences, offset) pairs, such as those from main.read_sentence_batches;
+    the sentences of a window are sorted by length and batched together, and
+    write_window(sentences, offset, output) is called with the linearized
+    trees of each window, in input order. With a parse_cache.ParseCache,
+    cached sentences skip the encoder and decoder, and repeated sentences in
+    a window are parsed once. Returns the stages and the wall time taken.
+    """
+    import parse_nk
+
+    dummy_tag = parser.dummy_tag
+
+    def make_batches():
+        for sentences, offset in windows:
+            tagged_sentences = [[(dummy_tag, word) for word in sentence] for sentence in sentences]
+            # copies[j] lists the sentences of the window that get the tree
+            # of sentence to_parse[j]
+            to_parse = list(range(len(sentences)))
+            copies = [[i] for i in to_parse]
+            cached = {}
+            if cache is not None:
+                predicted, copies = cache.lookup(tagged_sentences)
+                cached = {i: tree for i, tree in enumerate(predicted) if tree is not None}
+                to_parse = [indices[0] for indices in copies]
+
+            batches = batching.make_batches(parser.sentence_lengths([tagged_sentences[i] for i in to_parse]),
+                estimate_bytes=parser.estimate_batch_bytes, **batch_limits)
+            # A window whose sentences are all cached still passes through
+            # as an empty batch, so that it is written in order
+            batches = batches or [[]]
+            for batch_num, batch in enumerate(batches):
+                yield dict(
+                    window=(sentences, offset) if batch_num == len(batches) - 1 else None,
+                    cached=cached if batch_num == 0 else {},
+                    copies=[copies[j] for j in batch],
+                    sentences=[tagged_sentences[to_parse[j]] for j in batch],
+                )
+
+    def prepare(item):
+        if item['sentences']:
+            item['prepared'] = parser.prepare_batch(item['sentences'])
+        return item
+
+    def encode(item):
+        if not item['sentences']:
+            return item
+        # Autocast state is per thread, so it is entered in this stage
+        with parse_nk.precision_context(precision):
+            if parser.f_tag is not None:
+                # Predicted tags are needed to build the trees, so models that
+                # predict tags are decoded here
+                item['trees'], _ = parser.parse_batch(item['sentences'], prepared=item.pop('prepared'))
+            else:
+                item['charts'] = parser.parse_batch(item['sentences'], return_label_scores_charts=True,
+                    prepared=item.pop('prepared'))
+        return item
+
+    window_trees = {}
+    def decode(item):
+        if 'trees' in item:
+            trees = item['trees']
+        elif 'charts' in item:
+            trees, _ = parser.decode_from_chart_batch(item['sentences'], item.pop('charts'))
+        else:
+            trees = []
+        trees = [tree.convert() for tree in trees]
+        if cache is not None and trees:
+            cache.put_many(item['sentences'], trees)
+        for i, tree in item['cached'].items():
+            window_trees[i] = tree.linearize()
+        for copies, tree in zip(item['copies'], trees):
+            for i in copies:
+                window_trees[i] = tree.linearize()
+        if item['window'] is not None:
+            sentences, offset = item['window']
+            write_window(sentences, offset, "".join("{}\n".format(window_trees[i]) for i in range(len(sentences))))
+            window_trees.clear()
+        return item
+
+    stages = [Stage("prepare", prepare), Stage("encode", encode), Stage("decode", decode)]
+    elapsed = run_pipeline(make_batches(), stages, queue_size=queue_size)
+    return stages, elapsed
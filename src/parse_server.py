@@ -0,0 +1,296 @@
+"""
+Long-lived parse server. A model is loaded once, and concurrent requests are
+grouped into micro-batches that are parsed together with parse_batch.
+
+The protocol is JSON lines over a Unix socket or a localhost TCP socket. Each
+request is one JSON object per line:
+    {"id": 1, "sentence": "we do n't uh i mean a lot of states do n't"}
+    {"id": 2, "words": ["yeah"], "output": "tags"}
+    {"command": "stats"}
+"id" is optional and echoed back. "output" is "tree" (the default, a
+linearized tree) or "tags" (one disfluency tag per word: "E" for words inside
+an EDITED node, "_" otherwise). Each request gets exactly one response line:
+    {"id": 1, "tree": "(S ...)"}
+    {"id": 2, "tags": ["_"]}
+    {"id": 3, "error": "..."}
+
+With serve_prefork, the listening socket is shared by several worker
+processes forked after the model is loaded, so the weights are stored once
+for all of them.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+
+import parse_nk
+import trees
+
+# A worker that exits within WORKER_MIN_UPTIME seconds of starting counts as
+# a failed start. Restarts after failed starts are delayed exponentially, and
+# a worker is not restarted after MAX_WORKER_FAILURES failed starts in a row.
+WORKER_MIN_UPTIME = 10
+MAX_WORKER_FAILURES = 5
+
+def disfluency_tags(tree, edited=False):
+    if isinstance(tree, trees.LeafTreebankNode):
+        return ["E" if edited else "_"]
+    edited = edited or tree.label == "EDITED"
+    return [tag for child in tree.children for tag in disfluency_tags(child, edited)]
+
+class MicroBatcher:
+    """
+    Collects sentences submitted from many threads into batches. A batch is
+    closed when adding the next sentence would exceed max_batch_tokens
+    (padded tokens, batch size * longest length), max_batch_bytes (as
+    estimated by the parser) or max_batch_size, or when max_wait seconds have
+    passed since its first sentence arrived. Lengths are those seen by the
+    encoder (parser.sentence_lengths: subwords for BERT), as in
+    batching.make_batches.
+
+    With a parse_cache.ParseCache, cached sentences are answered without
+    being batched, and identical sentences in a batch are parsed once.
+    """
+    def __init__(self, parser, max_batch_tokens=2000, max_batch_bytes=None, max_batch_size=100, max_wait=0.005, precision="fp32", cache=None):
+        self.parser = parser
+        self.cache = cache
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.precision = precision
+
+        self.requests = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.num_batches = 0
+        self.num_sentences = 0
+        self.parse_time = 0.0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sentence):
+        future = concurrent.futures.Future()
+        if self.cache is not None:
+            tree = self.cache.get(sentence)
+            if tree is not None:
+                future.set_result(tree)
+                return future
+        self.requests.put((sentence, future))
+        return future
+
+    def next_batch(self, carry):
+        first = carry if carry is not None else self.requests.get()
+        batch = [first]
+        max_len, = self.parser.sentence_lengths([first[0]])
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            item_len, = self.parser.sentence_lengths([item[0]])
+            padded_len = max(max_len, item_len)
+            if ((len(batch) + 1) * padded_len > self.max_batch_tokens
+                    or (self.max_batch_bytes is not None
+                        and self.parser.estimate_batch_bytes(len(batch) + 1, padded_len) > self.max_batch_bytes)):
+                # Start the next batch with this request
+                return batch, item
+            batch.append(item)
+            max_len = padded_len
+        return batch, None
+
+    def run(self):
+        carry = None
+        while True:
+            batch, carry = self.next_batch(carry)
+            futures = collections.OrderedDict()
+            for sentence, future in batch:
+                futures.setdefault(tuple(map(tuple, sentence)), (sentence, []))[1].append(future)
+            sentences = [sentence for sentence, _ in futures.values()]
+            start_time = time.time()
+            try:
+                with parse_nk.precision_context(self.precision):
+                    predicted, _ = self.parser.parse_batch(sentences)
+                predicted = [tree.convert() for tree in predicted]
+                if self.cache is not None:
+                    self.cache.put_many(sentences, predicted)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, sentence_futures), tree in zip(futures.values(), predicted):
+                for future in sentence_futures:
+                    future.set_result(tree)
+
+            with self.stats_lock:
+                self.num_batches += 1
+                self.num_sentences += len(batch)
+                self.parse_time += time.time() - start_time
+
+    def stats(self):
+        with self.stats_lock:
+            stats = {
+                'pid': os.getpid(),
+                'batches': self.num_batches,
+                'sentences': self.num_sentences,
+                'mean_batch_size': self.num_sentences / max(self.num_batches, 1),
+                'parse_seconds': self.parse_time,
+            }
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+class ParseRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            request = None
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.respond(request)
+            except Exception as e:
+                response = {'error': "{}: {}".format(type(e).__name__, e)}
+                # Clients that pipeline requests need the id to match errors
+                if isinstance(request, dict) and 'id' in request:
+                    response = {'id': request['id'], 'error': response['error']}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+class ParseServerMixin:
+    daemon_threads = True
+
+    def setup_parser(self, batcher, dummy_tag):
+        self.batcher = batcher
+        self.dummy_tag = dummy_tag
+
+    def respond(self, request):
+        response = {}
+        if 'id' in request:
+            response['id'] = request['id']
+
+        if request.get('command') == 'stats':
+            response['stats'] = self.batcher.stats()
+            return response
+
+        words = request['words'] if 'words' in request else request['sentence'].split()
+        if not words:
+            raise ValueError("Empty sentence")
+        output = request.get('output', 'tree')
+        if output not in ('tree', 'tags'):
+            raise ValueError("Unknown output type: {}".format(output))
+
+        tree = self.batcher.submit([(self.dummy_tag, word) for word in words]).result()
+        if output == 'tree':
+            response['tree'] = tree.linearize()
+        else:
+            response['tags'] = disfluency_tags(tree)
+        return response
+
+class ParseTCPServer(ParseServerMixin, socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class ParseUnixServer(ParseServerMixin, socketserver.ThreadingUnixStreamServer):
+        pass
+
+def make_server(socket_path=None, host="127.0.0.1", port=8765):
+    # The caller attaches a batcher with setup_parser before serving
+    if socket_path is not None:
+        return ParseUnixServer(socket_path, ParseRequestHandler)
+    else:
+        return ParseTCPServer((host, port), ParseRequestHandler)
+
+def share_parser_memory(parser):
+    """
+    Moves the parser's weights into shared memory, so that they stay shared
+    with forked workers even if pages are written to
+    """
+    for param in parser.parameters():
+        param.share_memory_()
+    for buf in parser.buffers():
+        buf.share_memory_()
+
+def split_cpus(num_workers):
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < num_workers:
+        return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+    chunk_size, remainder = divmod(len(cpus), num_workers)
+    subsets = []
+    start = 0
+    for i in range(num_workers):
+        end = start + chunk_size + (1 if i < remainder else 0)
+        subsets.append(cpus[start:end])
+        start = end
+    return subsets
+
+def serve_prefork(server, num_workers, start_worker):
+    """
+    Forks num_workers processes that all accept connections on server's
+    listening socket. In each child, start_worker(worker_num, cpus) is called
+    first; it should pin the process and attach a batcher to the server.
+    Workers that exit unexpectedly are restarted, with a backoff when they
+    fail right after starting (see WORKER_MIN_UPTIME). Returns in the parent
+    once it is interrupted or terminated, after stopping the workers, or once
+    every worker has failed to start too many times.
+    """
+    import signal
+
+    cpu_subsets = split_cpus(num_workers)
+    workers = {}
+    start_times = {}
+    failures = collections.Counter()
+
+    def fork_worker(worker_num):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                start_worker(worker_num, cpu_subsets[worker_num])
+                server.serve_forever()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(1)
+        workers[pid] = worker_num
+        start_times[worker_num] = time.time()
+
+    for worker_num in range(num_workers):
+        fork_worker(worker_num)
+
+    try:
+        while workers:
+            pid, status = os.wait()
+            worker_num = workers.pop(pid)
+            if time.time() - start_times[worker_num] < WORKER_MIN_UPTIME:
+                failures[worker_num] += 1
+            else:
+                failures[worker_num] = 0
+            if failures[worker_num] >= MAX_WORKER_FAILURES:
+                print("Worker {} (pid {}) exited with status {} after {} failed starts, not restarting".format(
+                    worker_num, pid, status, failures[worker_num]), flush=True)
+                continue
+            delay = 2 ** (failures[worker_num] - 1) if failures[worker_num] > 0 else 0
+            print("Worker {} (pid {}) exited with status {}, restarting in {}s".format(worker_num, pid, status, delay), flush=True)
+            time.sleep(delay)
+            fork_worker(worker_num)
+        print("No workers left, stopping", flush=True)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
@@ -0,0 +1,74 @@
+"""
+Background preparation of training batches. A Prefetcher runs an iterator
+(e.g. one that forms batches, splits them into sub-batches and calls
+NKChartParser.prepare_batch) in a thread, keeping up to depth items ready
+in a queue while the main thread runs the network. The torch forward and
+backward passes release the GIL, so the mostly-Python preparation overlaps
+with them.
+
+The time the main thread spends waiting for an item (stall time) and the
+number of items that were ready when it asked (queue depth) show whether
+preparation keeps up with training.
+"""
+
+import queue
+import threading
+import time
+
+class Prefetcher:
+    _done = object()
+
+    def __init__(self, items, depth=2):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.error = None
+        self.stall_time = 0.0
+        self.num_items = 0
+        self.total_depth = 0
+        self.thread = threading.Thread(target=self.run, args=(items,), daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, items):
+        try:
+            for item in items:
+                if not self.put(item):
+                    return
+        except BaseException as e:
+            self.error = e
+        self.put(self._done)
+
+    def __iter__(self):
+        try:
+            while True:
+                self.total_depth += self.queue.qsize()
+                start_time = time.perf_counter()
+                item = self.queue.get()
+                self.stall_time += time.perf_counter() - start_time
+                if item is self._done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self.num_items += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+    def stats(self):
+        return {
+            'items': self.num_items,
+            'stall_time': self.stall_time,
+            'mean_queue_depth': self.total_depth / max(self.num_items, 1),
+        }
@@ -0,0 +1,82 @@
+"""
+Slim checkpoint format for inference.
+
+A slim checkpoint consists of two files:
+  - <base>.json: the model spec (hyperparameters and vocabularies) together
+    with the name, dtype, shape and byte offset of each tensor
+  - <base>.bin: the raw tensor data, each tensor aligned to ALIGNMENT bytes
+
+Optimizer state is not included. At load time the .bin file is memory-mapped
+copy-on-write, so loading only costs page faults and processes on the same
+host that load the same file share the physical pages holding the weights.
+"""
+
+import json
+import os.path
+
+import numpy as np
+import torch
+
+import vocabulary
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+VOCAB_KEYS = ['tag_vocab', 'word_vocab', 'label_vocab', 'char_vocab']
+
+def get_weights_path(path):
+    assert path.endswith(".json"), "Slim checkpoints must have a .json extension"
+    return path[:-len(".json")] + ".bin"
+
+def save(path, spec, state_dict):
+    weights_path = get_weights_path(path)
+
+    tensor_infos = []
+    offset = 0
+    with open(weights_path, 'wb') as f:
+        for name, tensor in state_dict.items():
+            array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            f.write(array.tobytes())
+            tensor_infos.append({
+                'name': name,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'offset': offset,
+                })
+            offset += array.nbytes
+
+    info = {
+        'format_version': FORMAT_VERSION,
+        'weights': os.path.basename(weights_path),
+        'hparams': spec['hparams'],
+        'vocabs': {key: spec[key].to_dict() for key in VOCAB_KEYS},
+        'tensors': tensor_infos,
+    }
+    with open(path, 'w') as f:
+        json.dump(info, f)
+
+def load(path):
+    """
+    Returns (spec, state_dict), where the tensors in state_dict are views into
+    a copy-on-write memory map of the weights file
+    """
+    with open(path) as f:
+        info = json.load(f)
+    assert info['format_version'] == FORMAT_VERSION, "Unsupported slim checkpoint version"
+
+    spec = {key: vocabulary.Vocabulary.from_dict(info['vocabs'][key]) for key in VOCAB_KEYS}
+    spec['hparams'] = info['hparams']
+
+    weights_path = os.path.join(os.path.dirname(path), info['weights'])
+    weights = np.memmap(weights_path, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for tensor_info in info['tensors']:
+        dtype = np.dtype(tensor_info['dtype'])
+        shape = tuple(tensor_info['shape'])
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        start = tensor_info['offset']
+        array = weights[start:start + nbytes].view(dtype).reshape(shape)
+        state_dict[tensor_info['name']] = torch.from_numpy(array)
+    return spec, state_dict
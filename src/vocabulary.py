@@ -42,3 +42,23 @@ class Vocabulary(object):
 
     def freeze(self):
         self.frozen = True
+
+    def to_dict(self):
+        return {
+            'values': self.values,
+            'counts': [self.counts[value] for value in self.values],
+            'frozen': self.frozen,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        vocab = cls()
+        for value, count in zip(d['values'], d['counts']):
+            # JSON turns tuple-valued entries (e.g. labels) into lists
+            if isinstance(value, list):
+                value = tuple(value)
+            vocab.indices[value] = len(vocab.values)
+            vocab.values.append(value)
+            vocab.counts[value] = count
+        vocab.frozen = d['frozen']
+        return vocab
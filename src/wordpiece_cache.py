@@ -0,0 +1,67 @@
+"""
+Wordpiece tokenization of a whole dataset, computed once and stored next to
+the treebank as <treebank path>.wordpieces.npz. Loading it fills the
+parser's per-sentence cache, so that neither batching (sentence_lengths)
+nor prepare_batch tokenizes the dataset's sentences again.
+
+The file holds the concatenated wordpiece ids and word start/end masks of
+all sentences, their offsets, and a key over the words and the tokenizer
+settings. A file whose key does not match is recomputed.
+"""
+
+import hashlib
+import json
+import os.path
+
+import numpy as np
+
+def get_path(treebank_path):
+    return treebank_path + ".wordpieces.npz"
+
+def dataset_key(parser, sentences):
+    hparams = parser.spec['hparams']
+    key = hashlib.sha1()
+    key.update(json.dumps([
+        hparams['bert_model'], hparams['bert_do_lower_case'], hparams['bert_transliterate'],
+        sorted(parser.bert_tokenizer.vocab.items(), key=lambda item: item[1]),
+        [[word for _, word in sentence] for sentence in sentences],
+    ]).encode('utf-8'))
+    return key.hexdigest()
+
+def save(path, key, encoded):
+    offsets = np.cumsum([0] + [len(input_ids) for input_ids, _, _ in encoded])
+    np.savez(path,
+        key=np.asarray(key),
+        offsets=offsets,
+        input_ids=np.concatenate([input_ids for input_ids, _, _ in encoded]).astype(np.int32),
+        word_start_mask=np.concatenate([mask for _, mask, _ in encoded]).astype(np.int8),
+        word_end_mask=np.concatenate([mask for _, _, mask in encoded]).astype(np.int8))
+
+def load(path, key):
+    """
+    Returns the encodings stored in path, or None if they are missing or
+    were computed for other sentences or another tokenizer
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if str(data['key']) != key:
+            return None
+        offsets = data['offsets']
+        arrays = [data[name].astype(int) for name in ['input_ids', 'word_start_mask', 'word_end_mask']]
+    return [tuple(array[start:end] for array in arrays) for start, end in zip(offsets[:-1], offsets[1:])]
+
+def add_dataset(parser, sentences, treebank_path):
+    """
+    Loads (or computes and saves) the wordpiece encodings of the sentences
+    of a treebank, and adds them to the parser's sentence cache
+    """
+    path = get_path(treebank_path)
+    key = dataset_key(parser, sentences)
+    encoded = load(path, key)
+    if encoded is None:
+        encoded = [parser.bert_encode(sentence) for sentence in sentences]
+        save(path, key, encoded)
+    for sentence, sentence_encoded in zip(sentences, encoded):
+        parser.bert_sentence_cache[tuple(word for _, word in sentence)] = sentence_encoded
+    return path
@@ -0,0 +1,46 @@
+import argparse
+
+import numpy as np
+import pytest
+
+import chart_store
+import main
+import vocabulary
+
+pytest.importorskip("parse_nk")
+
+class DummyParser:
+    dummy_tag = "UNK"
+
+def test_raw_chart_input_rejects_blank_lines(tmp_path):
+    input_path = tmp_path / "input.txt"
+    input_path.write_text("a b\n\nc\n")
+    args = argparse.Namespace(input_format="raw", input_path=str(input_path))
+    with pytest.raises(AssertionError, match="Line 2"):
+        main.read_chart_sentences(args, DummyParser())
+
+    input_path.write_text("a b\nc\n")
+    assert main.read_chart_sentences(args, DummyParser()) == [[("UNK", "a"), ("UNK", "b")], [("UNK", "c")]]
+
+def write_store(path, sentences, label_vocab, top_k):
+    rng = np.random.RandomState(0)
+    writer = chart_store.ChartWriter(path, "key", [len(sentence) for sentence in sentences], label_vocab,
+        dtype=np.float32, top_k=top_k, sentences=sentences)
+    for index, sentence in enumerate(sentences):
+        writer.write(index, rng.randn(len(sentence) + 1, len(sentence) + 1, label_vocab.size).astype(np.float32))
+    writer.close()
+
+@pytest.mark.parametrize("top_ks", [(None, 1), (2, 2)])
+def test_combine_charts_rejects_top_k_stores(tmp_path, top_ks):
+    label_vocab = vocabulary.Vocabulary()
+    for label in [(), ("S",), ("NP",), ("VP",)]:
+        label_vocab.index(label)
+    label_vocab.freeze()
+    sentences = [[("UNK", "a"), ("UNK", "b")]]
+
+    chart_paths = [str(tmp_path / "charts{}.json".format(i)) for i in range(len(top_ks))]
+    for chart_path, top_k in zip(chart_paths, top_ks):
+        write_store(chart_path, sentences, label_vocab, top_k)
+    args = argparse.Namespace(chart_paths=chart_paths, output_path=None, test_path=None, evalb_dir=None)
+    with pytest.raises(AssertionError, match="--top-k"):
+        main.run_combine_charts(args)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import chart_store
+import trees
+import vocabulary
+
+parse_nk = pytest.importorskip("parse_nk")
+
+def make_label_vocab():
+    label_vocab = vocabulary.Vocabulary()
+    for label in [(), ("S",), ("NP",), ("VP",), ("PP",), ("EDITED",)]:
+        label_vocab.index(label)
+    label_vocab.freeze()
+    return label_vocab
+
+def decoded_labels(sentence, chart, label_vocab):
+    tree, _ = parse_nk.decode_chart(sentence, chart, label_vocab)
+    labels = []
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, trees.InternalParseNode):
+            labels.append((node.left, node.right, node.label))
+            nodes.extend(node.children)
+    return sorted(labels)
+
+@pytest.mark.parametrize("top_k", [None, 1, 3])
+def test_top_k_round_trip_decodes_stored_labels(tmp_path, top_k):
+    rng = np.random.RandomState(0)
+    label_vocab = make_label_vocab()
+    sentences = [[("NN", "w{}".format(i)) for i in range(n)] for n in [1, 4, 7]]
+    charts = []
+    for sentence in sentences:
+        chart = rng.randn(len(sentence) + 1, len(sentence) + 1, label_vocab.size).astype(np.float32)
+        chart[:, :, 0] = 0
+        charts.append(chart)
+
+    path = str(tmp_path / "charts.json")
+    writer = chart_store.ChartWriter(path, "key", [len(sentence) for sentence in sentences], label_vocab,
+        dtype=np.float32, top_k=top_k)
+    for index, chart in enumerate(charts):
+        writer.write(index, chart)
+    writer.close()
+
+    store = chart_store.ChartStore(path)
+    for index, (sentence, chart) in enumerate(zip(sentences, charts)):
+        stored = store.chart(index)
+        span_i, span_j = chart_store.span_indices(len(sentence))
+        assert np.array_equal(
+            stored[span_i, span_j, 1:].argmax(-1), chart[span_i, span_j, 1:].argmax(-1))
+        assert decoded_labels(sentence, stored, label_vocab) == decoded_labels(sentence, chart, label_vocab)
@@ -0,0 +1,55 @@
+import sqlite3
+
+import parse_cache
+import trees
+
+def make_tree():
+    return trees.InternalTreebankNode("S", [
+        trees.InternalTreebankNode("PRN", [
+            trees.LeafTreebankNode("-LRB-", "("),
+            trees.LeafTreebankNode("UH", "uh"),
+            trees.LeafTreebankNode("-RRB-", ")"),
+        ]),
+        trees.LeafTreebankNode("NN", "a(b)c"),
+    ])
+
+def test_disk_round_trip_with_brackets_in_words(tmp_path):
+    path = str(tmp_path / "cache.db")
+    tree = make_tree()
+    sentence = [(leaf.tag, leaf.word) for leaf in tree.leaves()]
+
+    cache = parse_cache.ParseCache("model", path=path)
+    cache.put_many([sentence], [tree])
+    cache.close()
+
+    cache = parse_cache.ParseCache("model", path=path)
+    cached = cache.get(sentence)
+    assert cached is not None
+    assert cache.stats()['disk_hits'] == 1
+    assert [(leaf.tag, leaf.word) for leaf in cached.leaves()] == sentence
+    assert cached.linearize() == tree.linearize()
+    assert cache.get(sentence) is cached
+    cache.close()
+
+def test_unreadable_disk_entry_is_a_miss(tmp_path):
+    path = str(tmp_path / "cache.db")
+    tree = make_tree()
+    sentence = [(leaf.tag, leaf.word) for leaf in tree.leaves()]
+
+    cache = parse_cache.ParseCache("model", path=path)
+    cache.close()
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO parses VALUES (?, ?, ?)",
+        ("model", parse_cache.json.dumps(parse_cache.ParseCache.key(sentence)), tree.linearize()))
+    db.commit()
+    db.close()
+
+    cache = parse_cache.ParseCache("model", path=path)
+    assert cache.get(sentence) is None
+    assert cache.stats()['misses'] == 1
+    assert cache.parse([sentence], lambda sentences: [tree for _ in sentences])[0] is tree
+    cache.close()
+
+    cache = parse_cache.ParseCache("model", path=path)
+    assert cache.get(sentence).linearize() == tree.linearize()
+    cache.close()